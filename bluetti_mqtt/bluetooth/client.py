@@ -1,7 +1,7 @@
 import asyncio
 from enum import Enum, auto, unique
 import logging
-from typing import Union
+from typing import Optional, Union
 from bleak import BleakClient, BleakError
 from bleak.exc import BleakDeviceNotFoundError
 from bluetti_mqtt.core import DeviceCommand
@@ -29,7 +29,7 @@ class BluetoothClient:
     notify_future: asyncio.Future
     notify_response: bytearray
 
-    def __init__(self, address: str):
+    def __init__(self, address: str, command_semaphore: Optional[asyncio.Semaphore] = None):
         self.address = address
         self.state = ClientState.NOT_CONNECTED
         self.name = None
@@ -38,6 +38,10 @@ class BluetoothClient:
         self.notify_future = None
         self.loop = asyncio.get_running_loop()
 
+        # Shared between clients to cap outstanding commands on the adapter.
+        # A client only has one command in flight, so its own is a no-op.
+        self.command_semaphore = command_semaphore or asyncio.Semaphore(1)
+
     @property
     def is_ready(self):
         return self.state == ClientState.READY or self.state == ClientState.PERFORMING_COMMAND
@@ -115,15 +119,16 @@ class BluetoothClient:
                 self.notify_future = self.loop.create_future()
                 self.notify_response = bytearray()
 
-                # Make request
-                await self.client.write_gatt_char(
-                    self.WRITE_UUID,
-                    bytes(self.current_command))
+                async with self.command_semaphore:
+                    # Make request
+                    await self.client.write_gatt_char(
+                        self.WRITE_UUID,
+                        bytes(self.current_command))
 
-                # Wait for response
-                res = await asyncio.wait_for(
-                    self.notify_future,
-                    timeout=self.RESPONSE_TIMEOUT)
+                    # Wait for response
+                    res = await asyncio.wait_for(
+                        self.notify_future,
+                        timeout=self.RESPONSE_TIMEOUT)
                 if cmd_future:
                     cmd_future.set_result(res)
 
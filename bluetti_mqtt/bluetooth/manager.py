@@ -7,10 +7,13 @@ from .client import BluetoothClient
 
 
 class MultiDeviceManager:
+    DEFAULT_MAX_CONCURRENT_COMMANDS = 2
+
     clients: Dict[str, BluetoothClient]
 
-    def __init__(self, addresses: List[str]):
+    def __init__(self, addresses: List[str], max_concurrent_commands: int = DEFAULT_MAX_CONCURRENT_COMMANDS):
         self.addresses = addresses
+        self.max_concurrent_commands = max_concurrent_commands
         self.clients = {}
 
     async def run(self):
@@ -19,8 +22,11 @@ class MultiDeviceManager:
         # Perform a blocking scan just to speed up initial connect
         await BleakScanner.discover()
 
-        # Start client loops
-        self.clients = {a: BluetoothClient(a) for a in self.addresses}
+        # Start client loops, optionally sharing a cap on in-flight commands
+        semaphore = None
+        if self.max_concurrent_commands > 0:
+            semaphore = asyncio.Semaphore(self.max_concurrent_commands)
+        self.clients = {a: BluetoothClient(a, semaphore) for a in self.addresses}
         await asyncio.gather(*[c.run() for c in self.clients.values()])
 
     def is_ready(self, address: str):
@@ -41,6 +47,10 @@ class MultiDeviceManager:
         else:
             raise Exception('Unknown address')
 
+    async def drain(self):
+        """Waits for every queued command to be performed"""
+        await asyncio.gather(*[c.command_queue.join() for c in self.clients.values()])
+
     async def perform_nowait(self, address: str, command: DeviceCommand):
         if address in self.clients:
             await self.clients[address].perform_nowait(command)
@@ -1,8 +1,14 @@
 import asyncio
+from collections import deque
 from dataclasses import dataclass
+from enum import Enum, auto, unique
 import logging
-from typing import Callable, List, Union
-from bluetti_mqtt.core import BluettiDevice, DeviceCommand
+import time
+from typing import Callable, Deque, Dict, List, Optional, Tuple, Type, Union
+from bluetti_mqtt.core import BluettiDevice, DeviceCommand, ReadHoldingRegisters
+
+# Parsed fields that are only meaningful together with their pack_num
+PACK_DETAIL_FIELDS = {'pack_status', 'pack_battery_percent', 'pack_voltage', 'cell_voltages'}
 
 
 @dataclass(frozen=True)
@@ -10,6 +16,24 @@ class ParserMessage:
     device: BluettiDevice
     parsed: dict
 
+    def can_merge(self, other: 'ParserMessage') -> bool:
+        """Whether the two messages can be combined without losing any data"""
+        if self.device is not other.device:
+            return False
+
+        # Battery pack details from different packs can't be combined
+        if self._has_pack_details() or other._has_pack_details():
+            if 'pack_num' in self.parsed and 'pack_num' in other.parsed:
+                return self.parsed['pack_num'] == other.parsed['pack_num']
+        return True
+
+    def merge(self, other: 'ParserMessage') -> 'ParserMessage':
+        """Combines the parsed fields, preferring the values from other"""
+        return ParserMessage(self.device, {**self.parsed, **other.parsed})
+
+    def _has_pack_details(self):
+        return any(f in self.parsed for f in PACK_DETAIL_FIELDS)
+
 
 @dataclass(frozen=True)
 class CommandMessage:
@@ -17,38 +41,299 @@ class CommandMessage:
     command: DeviceCommand
 
 
+@dataclass(frozen=True)
+class DemandMessage:
+    """Signals whether anyone is consuming data (device of None means all devices)"""
+    device: Optional[BluettiDevice]
+    active: bool
+
+
+@dataclass(frozen=True)
+class RegisterMessage:
+    """An unparsed response to a polling command"""
+    device: BluettiDevice
+    command: ReadHoldingRegisters
+    response: bytes
+    timestamp: float
+
+
+Message = Union[ParserMessage, CommandMessage, DemandMessage, RegisterMessage]
+
+
+@unique
+class OverflowPolicy(Enum):
+    BLOCK = auto()  # Wait for the listener to catch up
+    DROP_OLDEST = auto()  # Discard the oldest queued message
+    COALESCE = auto()  # Merge into the newest queued message for the same device, or drop the oldest
+
+
+class Listener:
+    """
+    Each listener has its own bounded queue and worker, so that a slow
+    listener can't hold up delivery to the others.
+    """
+    pending: Deque[Tuple[float, Message]]
+
+    def __init__(self, cb: Callable, max_size: int, overflow: OverflowPolicy, batch: bool = False):
+        self.cb = cb
+        self.max_size = max_size
+        self.overflow = overflow
+        self.batch = batch
+        self.pending = deque()
+        self.subscriptions = 0
+        self.not_empty = None
+        self.not_full = None
+        self.idle = None
+
+        # Lag metrics
+        self.dropped = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    @property
+    def name(self):
+        return getattr(self.cb, '__qualname__', repr(self.cb))
+
+    async def put(self, msg: Message):
+        self._ensure_events()
+
+        if len(self.pending) >= self.max_size:
+            if self.overflow == OverflowPolicy.COALESCE and isinstance(msg, ParserMessage):
+                if self._coalesce(msg):
+                    return
+                self._drop_oldest()
+            elif self.overflow == OverflowPolicy.DROP_OLDEST and not isinstance(msg, CommandMessage):
+                self._drop_oldest()
+            else:
+                # Never drop commands - wait for space instead
+                while len(self.pending) >= self.max_size:
+                    self.not_full.clear()
+                    await self.not_full.wait()
+
+        self.pending.append((time.monotonic(), msg))
+        self.not_empty.set()
+        self.idle.clear()
+
+    async def run(self):
+        self._ensure_events()
+        while True:
+            await self.not_empty.wait()
+            if self.batch:
+                await self._dispatch_batch()
+                continue
+
+            queued_at, msg = self.pending.popleft()
+            if len(self.pending) == 0:
+                self.not_empty.clear()
+            self.not_full.set()
+
+            self._record_lag(queued_at)
+            await self.cb(msg)
+            self._check_idle()
+
+    async def join(self):
+        """Waits until everything queued has been handled"""
+        self._ensure_events()
+        await self.idle.wait()
+
+    @property
+    def is_idle(self):
+        return not self.idle or self.idle.is_set()
+
+    async def _dispatch_batch(self):
+        """Drains everything pending, merging consecutive parser messages for a device"""
+        batch: List[Message] = []
+        queued_at = self.pending[0][0]
+        while len(self.pending) > 0:
+            _, msg = self.pending.popleft()
+            last = batch[-1] if len(batch) > 0 else None
+            if isinstance(msg, ParserMessage) and isinstance(last, ParserMessage) and last.can_merge(msg):
+                batch[-1] = last.merge(msg)
+            else:
+                batch.append(msg)
+        self.not_empty.clear()
+        self.not_full.set()
+
+        self._record_lag(queued_at)
+        await self.cb(batch)
+        self._check_idle()
+
+    def _record_lag(self, queued_at: float):
+        self.last_lag = time.monotonic() - queued_at
+        self.max_lag = max(self.max_lag, self.last_lag)
+
+    def _check_idle(self):
+        if len(self.pending) == 0:
+            self.idle.set()
+
+    def _ensure_events(self):
+        if not self.not_empty:
+            self.not_empty = asyncio.Event()
+            self.not_full = asyncio.Event()
+            self.idle = asyncio.Event()
+            self.idle.set()
+
+    def _coalesce(self, msg: ParserMessage) -> bool:
+        # Only the newest queued message for the device can be merged into,
+        # otherwise its older values would be delivered after the new ones
+        for i in range(len(self.pending) - 1, -1, -1):
+            queued_at, queued = self.pending[i]
+            if isinstance(queued, ParserMessage) and queued.device is msg.device:
+                if not queued.can_merge(msg):
+                    return False
+                self.pending[i] = (queued_at, queued.merge(msg))
+                return True
+        return False
+
+    def _drop_oldest(self):
+        self.pending.popleft()
+        self.dropped += 1
+
+
+class Subscription:
+    """Returned when adding a listener, and used to remove it again"""
+    def __init__(self, bus: 'EventBus', msg_type: Type, listener: Listener):
+        self.bus = bus
+        self.msg_type = msg_type
+        self.listener = listener
+        self.active = True
+        listener.subscriptions += 1
+
+    def unsubscribe(self):
+        # The listener is shared by every subscription for the same callback
+        if not self.active:
+            return
+        self.active = False
+        self.listener.subscriptions -= 1
+        if self.listener.subscriptions == 0:
+            self.bus._remove_listener(self.msg_type, self.listener)
+
+
 class EventBus:
-    parser_listeners: List[Callable[[ParserMessage], None]]
-    command_listeners: List[Callable[[CommandMessage], None]]
-    queue: asyncio.Queue
+    DEFAULT_MAX_SIZE = 1000
+    LAG_REPORT_INTERVAL = 60
+
+    listeners: Dict[Type, List[Listener]]
 
     def __init__(self):
-        self.parser_listeners = []
-        self.command_listeners = []
-        self.queue = None
+        self.listeners = {ParserMessage: [], CommandMessage: [], DemandMessage: [], RegisterMessage: []}
+        self.workers = {}
+        self.running = False
 
-    def add_parser_listener(self, cb: Callable[[ParserMessage], None]):
-        self.parser_listeners.append(cb)
+    def add_parser_listener(
+        self,
+        cb: Callable[[ParserMessage], None],
+        max_size: int = DEFAULT_MAX_SIZE,
+        overflow: OverflowPolicy = OverflowPolicy.BLOCK,
+        batch: bool = False,
+    ) -> Subscription:
+        """Batch listeners are called with a list of all messages pending since the last call"""
+        return self._add_listener(ParserMessage, Listener(cb, max_size, overflow, batch))
 
-    def add_command_listener(self, cb: Callable[[CommandMessage], None]):
-        self.command_listeners.append(cb)
+    def add_command_listener(
+        self,
+        cb: Callable[[CommandMessage], None],
+        max_size: int = DEFAULT_MAX_SIZE,
+    ) -> Subscription:
+        return self._add_listener(CommandMessage, Listener(cb, max_size, OverflowPolicy.BLOCK))
 
-    async def put(self, msg: Union[ParserMessage, CommandMessage]):
-        if not self.queue:
-            self.queue = asyncio.Queue()
+    def add_demand_listener(
+        self,
+        cb: Callable[[DemandMessage], None],
+        max_size: int = DEFAULT_MAX_SIZE,
+        overflow: OverflowPolicy = OverflowPolicy.DROP_OLDEST,
+    ) -> Subscription:
+        return self._add_listener(DemandMessage, Listener(cb, max_size, overflow))
 
-        await self.queue.put(msg)
+    def add_register_listener(
+        self,
+        cb: Callable[[RegisterMessage], None],
+        max_size: int = DEFAULT_MAX_SIZE,
+        overflow: OverflowPolicy = OverflowPolicy.BLOCK,
+    ) -> Subscription:
+        return self._add_listener(RegisterMessage, Listener(cb, max_size, overflow))
 
-    """Reads messages and notifies listeners"""
-    async def run(self):
-        if not self.queue:
-            self.queue = asyncio.Queue()
+    async def put(self, msg: Message):
+        for listener in self.listeners[type(msg)]:
+            await listener.put(msg)
+
+    def stats(self) -> List[dict]:
+        """Returns the queue size and lag for each listener"""
+        return [
+            {
+                'listener': listener.name,
+                'queue_size': len(listener.pending),
+                'dropped': listener.dropped,
+                'last_lag': listener.last_lag,
+                'max_lag': listener.max_lag,
+            }
+            for listeners in self.listeners.values()
+            for listener in listeners
+        ]
 
+    async def drain(self):
+        """Waits until every listener has handled everything queued"""
         while True:
-            msg = await self.queue.get()
-            logging.debug(f'queue size: {self.queue.qsize()}')
-            if isinstance(msg, ParserMessage):
-                await asyncio.gather(*[pl(msg) for pl in self.parser_listeners])
-            elif isinstance(msg, CommandMessage):
-                await asyncio.gather(*[cl(msg) for cl in self.command_listeners])
-            self.queue.task_done()
+            busy = [li for listeners in self.listeners.values() for li in listeners if not li.is_idle]
+            if len(busy) == 0:
+                return
+            await asyncio.gather(*[li.join() for li in busy])
+
+    """Runs listener workers and reports their lag"""
+    async def run(self):
+        self.running = True
+        try:
+            for listeners in self.listeners.values():
+                for listener in listeners:
+                    self._start_worker(listener)
+
+            while True:
+                await asyncio.sleep(self.LAG_REPORT_INTERVAL)
+                if logging.getLogger().isEnabledFor(logging.DEBUG):
+                    for stat in self.stats():
+                        logging.debug(
+                            'Listener %s: queue size %d, dropped %d, max lag %.3fs',
+                            stat['listener'], stat['queue_size'], stat['dropped'], stat['max_lag'])
+                for listeners in self.listeners.values():
+                    for listener in listeners:
+                        listener.max_lag = 0.0
+        finally:
+            self.running = False
+            for worker in self.workers.values():
+                worker.cancel()
+
+    def _add_listener(self, msg_type: Type, listener: Listener) -> Subscription:
+        # Adding the same callback again shares the existing listener
+        existing = next((li for li in self.listeners[msg_type] if li.cb == listener.cb), None)
+        if existing:
+            return Subscription(self, msg_type, existing)
+
+        self.listeners[msg_type].append(listener)
+        if self.running:
+            self._start_worker(listener)
+        return Subscription(self, msg_type, listener)
+
+    def _remove_listener(self, msg_type: Type, listener: Listener):
+        if listener in self.listeners[msg_type]:
+            self.listeners[msg_type].remove(listener)
+        worker = self.workers.pop(listener, None)
+        if worker:
+            worker.cancel()
+
+    def _start_worker(self, listener: Listener):
+        task = asyncio.create_task(listener.run())
+        self.workers[listener] = task
+        task.add_done_callback(self._worker_done)
+
+    def _worker_done(self, task: asyncio.Task):
+        if task.cancelled():
+            return
+
+        # Listener errors are fatal, just like they were before listeners had workers
+        err = task.exception()
+        if err:
+            asyncio.get_event_loop().call_exception_handler({
+                'message': 'Event bus listener failed',
+                'exception': err,
+                'task': task,
+            })
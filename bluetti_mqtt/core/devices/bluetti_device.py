@@ -1,5 +1,6 @@
-from typing import Any, List
-from ..commands import ReadHoldingRegisters, WriteSingleRegister
+import struct
+from typing import Any, Dict, List, Tuple
+from ..commands import DeviceCommand, ReadHoldingRegisters, WriteMultipleRegisters, WriteSingleRegister
 from .struct import BoolField, DeviceStruct, EnumField
 
 
@@ -56,13 +57,56 @@ class BluettiDevice:
         return any(any(f.address in r for r in self.writable_ranges) for f in matches)
 
     def build_setter_command(self, field: str, value: Any):
+        address, value = self._setter_register(field, value)
+        return WriteSingleRegister(address, value)
+
+    def build_multiple_setter_commands(self, values: Dict[str, Any]) -> List[DeviceCommand]:
+        """Builds the minimal set of write commands to set all the given fields"""
+        registers = dict(self._setter_register(field, value) for field, value in values.items())
+        return self.build_write_commands(registers)
+
+    def _setter_register(self, field: str, value: Any) -> Tuple[int, int]:
         matches = [f for f in self.struct.fields if f.name == field]
-        device_field = next(f for f in matches if any(f.address in r for r in self.writable_ranges))
+        device_field = next((f for f in matches if any(f.address in r for r in self.writable_ranges)), None)
+        if device_field is None:
+            raise ValueError(f'{field} is not writable')
 
         # Convert value to an integer
         if isinstance(device_field, EnumField):
+            if not isinstance(value, str) or value not in device_field.enum.__members__:
+                raise ValueError(f'{field} has no option {value}')
             value = device_field.enum[value].value
         elif isinstance(device_field, BoolField):
             value = 1 if value else 0
 
-        return WriteSingleRegister(device_field.address, value)
+        # Registers are 16 bit unsigned integers
+        if not isinstance(value, int) or not 0 <= value <= 0xFFFF or not device_field.in_range(value):
+            raise ValueError(f'{field} is out of range: {value}')
+
+        return (device_field.address, value)
+
+    def build_write_commands(self, registers: Dict[int, int]) -> List[DeviceCommand]:
+        """
+        Builds the minimal set of write commands for the given register values,
+        merging contiguous registers within a writable range into one write.
+        """
+        # Split the sorted addresses into runs of contiguous writable registers
+        runs: List[List[int]] = []
+        for address in sorted(registers.keys()):
+            if len(runs) > 0:
+                last = runs[-1][-1]
+                if address == last + 1 and self._writable_range(address) == self._writable_range(last):
+                    runs[-1].append(address)
+                    continue
+            runs.append([address])
+
+        return [self._build_write_command(run, registers) for run in runs]
+
+    def _writable_range(self, address: int):
+        return next((r for r in self.writable_ranges if address in r), None)
+
+    def _build_write_command(self, addresses: List[int], registers: Dict[int, int]) -> DeviceCommand:
+        if len(addresses) == 1:
+            return WriteSingleRegister(addresses[0], registers[addresses[0]])
+        data = struct.pack(f'!{len(addresses)}H', *[registers[a] for a in addresses])
+        return WriteMultipleRegisters(addresses[0], data)
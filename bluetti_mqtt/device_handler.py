@@ -1,19 +1,55 @@
 import asyncio
 from bleak import BleakError
 import logging
+import math
+import struct
 import time
 from typing import Dict, List, cast
 from bluetti_mqtt.bluetooth import BadConnectionError, MultiDeviceManager, ModbusError, ParseError, build_device
-from bluetti_mqtt.bus import CommandMessage, EventBus, ParserMessage
-from bluetti_mqtt.core import BluettiDevice, ReadHoldingRegisters
+from bluetti_mqtt.bus import CommandMessage, DemandMessage, EventBus, ParserMessage, RegisterMessage
+from bluetti_mqtt.core import (
+    BluettiDevice,
+    DeviceCommand,
+    ReadHoldingRegisters,
+    WriteMultipleRegisters,
+    WriteSingleRegister
+)
 
 
 class DeviceHandler:
-    def __init__(self, addresses: List[str], interval: int, bus: EventBus):
-        self.manager = MultiDeviceManager(addresses)
+    WAKE_DURATION = 300  # How long a wake request keeps a device at full rate
+    STAGGER_DELAY = 1  # Phase offset between devices when polling as fast as possible
+    COMMAND_COALESCE_WINDOW = 0.25  # How long to collect register writes before sending them
+
+    def __init__(
+        self,
+        addresses: List[str],
+        interval: int,
+        bus: EventBus,
+        idle_interval: int = 0,
+        max_concurrent_commands: int = MultiDeviceManager.DEFAULT_MAX_CONCURRENT_COMMANDS,
+        parse_responses: bool = True,
+        publish_registers: bool = False,
+    ):
+        self.manager = MultiDeviceManager(addresses, max_concurrent_commands)
         self.devices: Dict[str, BluettiDevice] = {}
         self.interval = interval
+        self.idle_interval = idle_interval
+        self.epoch = time.monotonic()  # Polling slots for every device are aligned to this
+        self.parse_responses = parse_responses  # Otherwise sends RegisterMessage for parsing elsewhere
+        self.publish_registers = publish_registers  # Also sends RegisterMessage when parsing
         self.bus = bus
+        self.background_tasks = set()
+        self.polling_tasks: List[asyncio.Task] = []
+        self.stopped = False
+
+        # Register writes waiting to be sent, by device address
+        self.pending_writes: Dict[str, Dict[int, int]] = {}
+
+        # Demand tracking - until told otherwise we assume someone is listening
+        self.consumers_active = True
+        self.wake_until: Dict[str, float] = {}
+        self.wake_conditions: Dict[str, asyncio.Condition] = {}
 
     async def run(self):
         loop = asyncio.get_running_loop()
@@ -23,50 +59,129 @@ class DeviceHandler:
 
         # Connect to event bus
         self.bus.add_command_listener(self.handle_command)
+        self.bus.add_demand_listener(self.handle_demand)
 
         # Poll the clients
         logging.info('Starting to poll clients...')
-        polling_tasks = [self._poll(a) for a in self.manager.addresses]
-        pack_polling_tasks = [self._pack_poll(a) for a in self.manager.addresses]
-        await asyncio.gather(*(polling_tasks + pack_polling_tasks + [manager_task]))
+        polling_tasks = [self._poll(a, self._phase_offset(i)) for i, a in enumerate(self.manager.addresses)]
+        pack_polling_tasks = [self._pack_poll(a, self._phase_offset(i + 0.5))
+                              for i, a in enumerate(self.manager.addresses)]
+        self.polling_tasks = [loop.create_task(c) for c in polling_tasks + pack_polling_tasks]
+        try:
+            await asyncio.gather(*(self.polling_tasks + [manager_task]))
+        except asyncio.CancelledError:
+            if not self.stopped:
+                raise
+            # Keep the devices connected until we're cancelled as well
+            await manager_task
+
+    def stop_polling(self):
+        """Stops polling, while still performing commands"""
+        self.stopped = True
+        for task in self.polling_tasks:
+            task.cancel()
+
+    async def drain(self):
+        """Waits for pending writes, and any commands already sent to the devices"""
+        while len(self.background_tasks) > 0:
+            await asyncio.wait(set(self.background_tasks))
+        await self.manager.drain()
 
     async def handle_command(self, msg: CommandMessage):
-        if self.manager.is_ready(msg.device.address):
-            logging.debug(f'Performing command {msg.device}: {msg.command}')
-            await self.manager.perform_nowait(msg.device.address, msg.command)
+        if not self.manager.is_ready(msg.device.address):
+            return
+
+        # Collect register writes for a short window, so a burst of commands
+        # only sends the latest value for each register
+        if isinstance(msg.command, WriteSingleRegister):
+            registers = {msg.command.address: msg.command.value}
+        elif isinstance(msg.command, WriteMultipleRegisters):
+            values = struct.unpack(f'!{len(msg.command.data) // 2}H', msg.command.data)
+            registers = {msg.command.starting_address + i: v for i, v in enumerate(values)}
+        else:
+            await self._perform_command(msg.device, msg.command)
+            return
+
+        address = msg.device.address
+        if address in self.pending_writes:
+            self.pending_writes[address].update(registers)
+        else:
+            self.pending_writes[address] = registers
+            self._create_task(self._flush_writes(msg.device))
 
-    async def _poll(self, address: str):
+    async def handle_demand(self, msg: DemandMessage):
+        if msg.device is None:
+            self.consumers_active = msg.active
+            addresses = self.manager.addresses
+        elif msg.active:
+            self.wake_until[msg.device.address] = time.monotonic() + self.WAKE_DURATION
+            addresses = [msg.device.address]
+        else:
+            self.wake_until.pop(msg.device.address, None)
+            addresses = [msg.device.address]
+
+        # Interrupt any sleeping pollers so the new rate applies immediately
+        if msg.active:
+            for address in addresses:
+                if address in self.wake_conditions:
+                    async with self.wake_conditions[address]:
+                        self.wake_conditions[address].notify_all()
+
+    def polling_interval(self, address: str) -> int:
+        """Returns the interval to poll at, based on whether anyone wants the data"""
+        if self.idle_interval <= 0 or self.consumers_active:
+            return self.interval
+        if time.monotonic() < self.wake_until.get(address, 0):
+            return self.interval
+        return self.idle_interval
+
+    def _phase_offset(self, slot: float) -> float:
+        """Spreads out the polling loops so devices don't hit the adapter at once"""
+        if self.interval > 0:
+            return self.interval * slot / len(self.manager.addresses)
+        else:
+            return self.STAGGER_DELAY * slot
+
+    async def _poll(self, address: str, phase_offset: float):
+        aligned = False
         while True:
             if not self.manager.is_ready(address):
                 logging.debug(f'Waiting for connection to {address} to start polling...')
+                aligned = False
                 await asyncio.sleep(1)
                 continue
 
-            device = self._get_device(address)
+            # Wait for our slot after (re)connecting, so we stay out of phase with other devices
+            if not aligned:
+                aligned = True
+                await self._align(address, phase_offset)
+
+            device = self.get_device(address)
 
             # Send all polling commands
-            start_time = time.monotonic()
-            for command in device.polling_commands:
-                await self._poll_with_command(device, command)
-            elapsed = time.monotonic() - start_time
+            await self._poll_with_commands(device, device.polling_commands)
 
             # Limit polling rate if interval provided
-            if self.interval > 0 and self.interval > elapsed:
-                await asyncio.sleep(self.interval - elapsed)
+            await self._sleep(address, phase_offset)
 
-    async def _pack_poll(self, address: str):
+    async def _pack_poll(self, address: str, phase_offset: float):
+        aligned = False
         while True:
             if not self.manager.is_ready(address):
                 logging.debug(f'Waiting for connection to {address} to start pack polling...')
+                aligned = False
                 await asyncio.sleep(1)
                 continue
 
+            if not aligned:
+                aligned = True
+                await self._align(address, phase_offset)
+
             # Break if there's nothing to poll
-            device = self._get_device(address)
+            device = self.get_device(address)
             if len(device.pack_logging_commands) == 0:
                 break
 
-            start_time = time.monotonic()
             for pack in range(1, device.pack_num_max + 1):
                 # Send pack set command if the device supports more than 1 pack
                 if device.pack_num_max > 1:
@@ -75,29 +190,115 @@ class DeviceHandler:
                     await asyncio.sleep(10)  # We need to wait after switching packs for the data to be available
 
                 # Poll
-                for command in device.pack_logging_commands:
-                    await self._poll_with_command(device, command)
-            elapsed = time.monotonic() - start_time
+                await self._poll_with_commands(device, device.pack_logging_commands)
 
             # Limit polling rate if interval provided
-            if self.interval > 0 and self.interval > elapsed:
-                await asyncio.sleep(self.interval - elapsed)
+            await self._sleep(address, phase_offset)
+
+    async def _align(self, address: str, phase_offset: float):
+        """Waits for the device's first polling slot after (re)connecting"""
+        if self.polling_interval(address) > 0:
+            await self._sleep(address, phase_offset)
+        else:
+            # Without an interval there are no slots, and connecting takes
+            # longer than the offsets, so stagger from the connection instead
+            await asyncio.sleep(phase_offset)
+
+    async def _sleep(self, address: str, phase_offset: float):
+        """Sleeps until the next polling slot for the device, or until a consumer asks for data"""
+        now = time.monotonic()
+        interval = self.polling_interval(address)
+        if interval <= 0:
+            return
 
-    async def _poll_with_command(self, device: BluettiDevice, command: ReadHoldingRegisters):
+        # Slots repeat every interval from the shared epoch, so devices stay
+        # out of phase however long each poll takes
+        slot = self.epoch + phase_offset
+        if slot < now:
+            slot += math.ceil((now - slot) / interval) * interval
+        if slot <= now:
+            return
+
+        if address not in self.wake_conditions:
+            self.wake_conditions[address] = asyncio.Condition()
+        condition = self.wake_conditions[address]
+        async with condition:
+            try:
+                await asyncio.wait_for(condition.wait(), timeout=slot - now)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _poll_with_commands(self, device: BluettiDevice, commands: List[ReadHoldingRegisters]):
+        """Polls with each command, publishing the combined results as one message"""
+        parsed = {}
+        for command in commands:
+            parsed.update(await self._poll_with_command(device, command))
+        if len(parsed) > 0:
+            await self.bus.put(ParserMessage(device, parsed))
+
+    async def _poll_with_command(self, device: BluettiDevice, command: ReadHoldingRegisters) -> dict:
         response_future = await self.manager.perform(device.address, command)
         try:
             response = cast(bytes, await response_future)
-            body = command.parse_response(response)
-            parsed = device.parse(command.starting_address, body)
-            await self.bus.put(ParserMessage(device, parsed))
+            if not self.parse_responses or self.publish_registers:
+                await self.bus.put(RegisterMessage(device, command, bytes(response), time.time()))
+            if self.parse_responses:
+                body = command.parse_response(response)
+                return device.parse(command.starting_address, body)
         except ParseError:
             logging.debug('Got a parse exception...')
         except ModbusError as err:
             logging.debug(f'Got an invalid request error for {command}: {err}')
         except (BadConnectionError, BleakError) as err:
             logging.debug(f'Needed to disconnect due to error: {err}')
+        return {}
+
+    async def _flush_writes(self, device: BluettiDevice):
+        await asyncio.sleep(self.COMMAND_COALESCE_WINDOW)
+        registers = self.pending_writes.pop(device.address)
+        for command in device.build_write_commands(registers):
+            await self._perform_command(device, command)
+
+    async def _perform_command(self, device: BluettiDevice, command: DeviceCommand):
+        logging.debug(f'Performing command {device}: {command}')
+        response_future = await self.manager.perform(device.address, command)
+
+        # Publish the new value as soon as the write completes, without
+        # blocking the event bus while we wait on the device
+        self._create_task(self._confirm_write(device, command, response_future))
+
+    def _create_task(self, coro):
+        task = asyncio.create_task(coro)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+
+    async def _confirm_write(self, device: BluettiDevice, command: DeviceCommand, response_future: asyncio.Future):
+        try:
+            response = cast(bytes, await response_future)
+        except (ModbusError, BadConnectionError, BleakError) as err:
+            logging.warn(f'Command {command} failed for {device}: {err}')
+            return
+
+        # This runs in the background, so errors would otherwise crash the service
+        try:
+            await self._publish_write(device, command, response)
+        except Exception:
+            logging.exception(f'Error publishing the result of {command} for {device}:')
+
+    async def _publish_write(self, device: BluettiDevice, command: DeviceCommand, response: bytes):
+        if isinstance(command, WriteSingleRegister) and self.parse_responses:
+            # The device echoes the written value back, so we can parse it directly
+            parsed = device.parse(command.address, command.parse_response(response))
+            if len(parsed) > 0:
+                await self.bus.put(ParserMessage(device, parsed))
+        elif isinstance(command, WriteSingleRegister):
+            await self._poll_with_commands(device, [ReadHoldingRegisters(command.address, 1)])
+        elif isinstance(command, WriteMultipleRegisters):
+            # The echo only contains the range, so read back the registers
+            quantity = len(command.data) // 2
+            await self._poll_with_commands(device, [ReadHoldingRegisters(command.starting_address, quantity)])
 
-    def _get_device(self, address: str):
+    def get_device(self, address: str):
         if address not in self.devices:
             name = self.manager.get_name(address)
             self.devices[address] = build_device(address, name)
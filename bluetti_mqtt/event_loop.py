@@ -0,0 +1,60 @@
+import asyncio
+import logging
+import time
+from typing import List
+
+
+def install_uvloop() -> bool:
+    """Switches asyncio to uvloop if it's installed"""
+    try:
+        import uvloop
+    except ImportError:
+        logging.warn('uvloop is not installed - using the default event loop')
+        return False
+
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    logging.debug('Using uvloop event loop')
+    return True
+
+
+class LoopLagMonitor:
+    """
+    Measures how late the event loop is to run scheduled callbacks, and
+    periodically logs percentiles of that delay. High lag means something is
+    hogging the loop, and bluetooth notifications or MQTT publishes are
+    waiting their turn.
+    """
+    SAMPLE_INTERVAL = 0.1
+
+    samples: List[float]
+
+    def __init__(self, report_interval: int, name: str = 'main'):
+        self.report_interval = report_interval
+        self.name = name
+        self.samples = []
+
+    async def run(self):
+        next_report = time.monotonic() + self.report_interval
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(self.SAMPLE_INTERVAL)
+            now = time.monotonic()
+            self.samples.append(max(now - start - self.SAMPLE_INTERVAL, 0))
+
+            if now >= next_report:
+                self._report()
+                self.samples = []
+                next_report = now + self.report_interval
+
+    def _report(self):
+        samples = sorted(self.samples)
+        if len(samples) == 0:
+            return
+
+        def percentile(p: float):
+            return samples[int(p * (len(samples) - 1))] * 1000
+
+        logging.info(
+            f'Event loop lag ({self.name}): p50 {percentile(0.5):.1f}ms, p95 {percentile(0.95):.1f}ms, '
+            f'p99 {percentile(0.99):.1f}ms, max {samples[-1] * 1000:.1f}ms'
+        )
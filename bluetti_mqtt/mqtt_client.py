@@ -1,14 +1,20 @@
 import asyncio
 from dataclasses import dataclass
+from decimal import Decimal
 from enum import auto, Enum, unique
 import json
 import logging
 import re
-from typing import List, Optional
-from asyncio_mqtt import Client, MqttError
+import struct
+import time
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple, Union
+from asyncio_mqtt import Client, MqttError, ProtocolVersion
 from paho.mqtt.client import MQTTMessage
-from bluetti_mqtt.bus import CommandMessage, EventBus, ParserMessage
-from bluetti_mqtt.core import BluettiDevice, DeviceCommand
+from paho.mqtt.properties import Properties
+from bluetti_mqtt.bus import CommandMessage, DemandMessage, EventBus, OverflowPolicy, ParserMessage, RegisterMessage
+from bluetti_mqtt.core import BluettiDevice
+from bluetti_mqtt.mqtt_publisher import MqttPublisher
+from bluetti_mqtt.spool import DiskSpool
 
 
 @unique
@@ -19,6 +25,40 @@ class MqttFieldType(Enum):
     BUTTON = auto()
 
 
+@dataclass(frozen=True)
+class Deadband:
+    """Changes smaller than either limit are treated as noise and not published"""
+    absolute: float = 0
+    percent: float = 0
+
+    def contains(self, last: Any, value: Any) -> bool:
+        if isinstance(value, dict):
+            return (
+                isinstance(last, dict) and value.keys() == last.keys()
+                and all(self.contains(last[k], v) for k, v in value.items())
+            )
+        if isinstance(value, (list, tuple)):
+            return (
+                isinstance(last, (list, tuple)) and len(value) == len(last)
+                and all(self.contains(a, b) for a, b in zip(last, value))
+            )
+        if _is_number(value) and _is_number(last):
+            delta = abs(float(value) - float(last))
+            return delta <= self.absolute or delta <= abs(float(last)) * self.percent / 100
+        return value == last
+
+    @classmethod
+    def parse(cls, limit: str) -> 'Deadband':
+        """Parses an absolute limit like 0.5, or a percentage like 2%"""
+        if limit.endswith('%'):
+            return cls(percent=float(limit[:-1]))
+        return cls(absolute=float(limit))
+
+
+def _is_number(value: Any) -> bool:
+    return isinstance(value, (int, float, Decimal)) and not isinstance(value, bool)
+
+
 @dataclass(frozen=True)
 class MqttFieldConfig:
     type: MqttFieldType
@@ -26,9 +66,16 @@ class MqttFieldConfig:
     advanced: bool  # Do not export by default to Home Assistant
     home_assistant_extra: dict
     id_override: Optional[str] = None  # Used to override Home Assistant field id
+    deadband: Optional[Deadband] = None  # Used to skip publishing noisy readings
+
 
+PACK_DETAILS_DEADBAND = Deadband(absolute=0.02)  # Cell voltages jitter by a count or two
 
-COMMAND_TOPIC_RE = re.compile(r'^bluetti/command/(\w+)-(\d+)/([a-z_]+)$')
+
+WAKE_TOPIC_RE = re.compile(r'^bluetti/wake/(\w+)-(\d+)$')
+HOME_ASSISTANT_STATUS_TOPIC = 'homeassistant/status'
+REGISTER_HEADER = struct.Struct('!dH')  # Timestamp and starting address of raw register messages
+DISCOVERY_ORIGIN = {'name': 'bluetti_mqtt', 'support_url': 'http://github.com/warhammerkid/bluetti_mqtt'}
 NORMAL_DEVICE_FIELDS = {
     'dc_input_power': MqttFieldConfig(
         type=MqttFieldType.NUMERIC,
@@ -136,7 +183,8 @@ NORMAL_DEVICE_FIELDS = {
             'device_class': 'voltage',
             'state_class': 'measurement',
             'force_update': True,
-        }
+        },
+        deadband=Deadband(absolute=0.5),
     ),
     'internal_current_one': MqttFieldConfig(
         type=MqttFieldType.NUMERIC,
@@ -172,7 +220,8 @@ NORMAL_DEVICE_FIELDS = {
             'device_class': 'frequency',
             'state_class': 'measurement',
             'force_update': True,
-        }
+        },
+        deadband=Deadband(absolute=0.05),
     ),
     'internal_current_two': MqttFieldConfig(
         type=MqttFieldType.NUMERIC,
@@ -208,7 +257,8 @@ NORMAL_DEVICE_FIELDS = {
             'device_class': 'voltage',
             'state_class': 'measurement',
             'force_update': True,
-        }
+        },
+        deadband=Deadband(absolute=0.5),
     ),
     'internal_current_three': MqttFieldConfig(
         type=MqttFieldType.NUMERIC,
@@ -244,7 +294,8 @@ NORMAL_DEVICE_FIELDS = {
             'device_class': 'frequency',
             'state_class': 'measurement',
             'force_update': True,
-        }
+        },
+        deadband=Deadband(absolute=0.05),
     ),
     'total_battery_voltage': MqttFieldConfig(
         type=MqttFieldType.NUMERIC,
@@ -256,7 +307,8 @@ NORMAL_DEVICE_FIELDS = {
             'device_class': 'voltage',
             'state_class': 'measurement',
             'force_update': True,
-        }
+        },
+        deadband=Deadband(absolute=0.2),
     ),
     'total_battery_current': MqttFieldConfig(
         type=MqttFieldType.NUMERIC,
@@ -414,7 +466,8 @@ DC_INPUT_FIELDS = {
             'device_class': 'voltage',
             'state_class': 'measurement',
             'force_update': True,
-        }
+        },
+        deadband=Deadband(absolute=0.5),
     ),
     'dc_input_power1': MqttFieldConfig(
         type=MqttFieldType.NUMERIC,
@@ -442,6 +495,71 @@ DC_INPUT_FIELDS = {
     ),
 }
 
+DC_INPUT_SOURCE_FIELDS = {  # Maps DC input fields to the parsed field they come from
+    'dc_input_voltage1': 'internal_dc_input_voltage',
+    'dc_input_power1': 'internal_dc_input_power',
+    'dc_input_current1': 'internal_dc_input_current',
+}
+
+
+def _encode_numeric(value: Any) -> bytes:
+    return str(value).encode()
+
+
+def _encode_bool(value: Any) -> bytes:
+    return b'ON' if value else b'OFF'
+
+
+def _encode_enum(value: Any) -> bytes:
+    return value.name.encode()
+
+
+FIELD_ENCODERS = {
+    MqttFieldType.NUMERIC: _encode_numeric,
+    MqttFieldType.BOOL: _encode_bool,
+    MqttFieldType.BUTTON: _encode_bool,
+    MqttFieldType.ENUM: _encode_enum,
+}
+
+
+@dataclass(frozen=True)
+class StateField:
+    """The precomputed topic and payload encoder for a parsed field of a device"""
+    name: str  # Name in the state document
+    topic: str
+    encode: Callable[[Any], bytes]
+    numeric: bool
+    deadband: Optional[Deadband] = None
+    force_update: bool = False  # Home Assistant records every update, so unchanged values are still published
+
+
+def _decode_numeric(payload: bytes) -> int:
+    return int(payload.decode('ascii'))
+
+
+def _decode_bool(payload: bytes) -> bool:
+    return payload == b'ON'
+
+
+def _decode_enum(payload: bytes) -> str:
+    return payload.decode('ascii')
+
+
+FIELD_DECODERS = {
+    MqttFieldType.NUMERIC: _decode_numeric,
+    MqttFieldType.BOOL: _decode_bool,
+    MqttFieldType.BUTTON: _decode_bool,
+    MqttFieldType.ENUM: _decode_enum,
+}
+
+
+@dataclass(frozen=True)
+class CommandRoute:
+    """The device and field a command topic sets (field of None means a JSON command for several fields)"""
+    device: BluettiDevice
+    field: Optional[str] = None
+    decode: Optional[Callable[[bytes], Any]] = None
+
 
 def battery_pack_fields(pack: int):
     return {
@@ -485,9 +603,100 @@ def battery_pack_fields(pack: int):
     }
 
 
+@dataclass(frozen=True)
+class StateUpdate:
+    """An encoded state message, ready to publish to any broker"""
+    topic: str
+    payload: bytes
+    value: Any = None
+    deadband: Optional[Deadband] = None
+    force_update: bool = False
+    key: Optional[str] = None  # Updates with the same key replace each other - defaults to the topic
+
+
+class MqttBroker:
+    """
+    A broker to publish to. Each broker has its own pending state and
+    publishing pipeline, so that a slow broker can't hold up the others.
+    """
+    pending: Dict[str, StateUpdate]
+    pending_devices: Dict[BluettiDevice, None]
+    published: Dict[str, Tuple[bytes, float, Any]]
+
+    def __init__(
+        self,
+        hostname: str,
+        port: int = 1883,
+        username: Optional[str] = None,
+        password: Optional[str] = None,
+        spool: Optional[DiskSpool] = None,
+        accept_commands: bool = False,
+    ):
+        self.hostname = hostname
+        self.port = port
+        self.username = username
+        self.password = password
+        self.spool = spool
+        self.connected = False
+
+        # Brokers bridged to each other would deliver each command more than
+        # once, so mirrors normally don't subscribe to commands
+        self.accept_commands = accept_commands
+
+        # Whether Home Assistant on this broker is online, once it's said so
+        self.consumers_active: Optional[bool] = None
+        self.topic_alias_maximum = 0  # From the broker, when using MQTT v5
+
+        # Only the latest update for each topic waits to be published, so if
+        # the broker falls behind it gets the newest state without a backlog
+        self.pending = {}
+        self.pending_devices = {}
+        self.has_pending = asyncio.Event()
+        self.flushed = asyncio.Event()  # Set once everything pending has been published
+        self.flushed.set()
+        self.replaced = 0
+
+        # Last payload, publish time and value per state topic
+        self.published = {}
+
+        # Devices that have been announced to Home Assistant on this broker
+        self.discovered: Set[BluettiDevice] = set()
+
+    @property
+    def name(self):
+        return f'{self.hostname}:{self.port}'
+
+    def put(self, device: Optional[BluettiDevice], updates: List[StateUpdate]):
+        if device:
+            self.pending_devices[device] = None
+        for update in updates:
+            key = update.key or update.topic
+            if key in self.pending:
+                self.replaced += 1
+            self.pending[key] = update
+        self.has_pending.set()
+        self.flushed.clear()
+
+    def take(self) -> Tuple[List[BluettiDevice], List[StateUpdate]]:
+        """Removes and returns everything pending, in the order it was first added"""
+        devices = list(self.pending_devices.keys())
+        updates = list(self.pending.values())
+        self.pending_devices = {}
+        self.pending = {}
+        self.has_pending.clear()
+        return devices, updates
+
+    def clear(self):
+        self.take()
+        self.flushed.set()
+        self.replaced = 0
+
+
 class MQTTClient:
+    DISCOVERY_READ_TIMEOUT = 2
+
     devices: List[BluettiDevice]
-    message_queue: asyncio.Queue
+    brokers: List[MqttBroker]
 
     def __init__(
         self,
@@ -497,87 +706,313 @@ class MQTTClient:
         port: int = 1883,
         username: Optional[str] = None,
         password: Optional[str] = None,
+        state_max_age: int = 0,
+        state_format: str = 'topics',
+        state_qos: int = 0,
+        discovery_qos: int = 0,
+        max_in_flight: int = 20,
+        skip_unchanged_discovery: bool = False,
+        discovery_format: str = 'entity',
+        spool: Optional[DiskSpool] = None,
+        spool_replay_rate: int = 50,
+        mirrors: Optional[List[MqttBroker]] = None,
+        publish_registers: bool = False,
+        mqtt_v5: bool = False,
+        state_expiry: int = 0,
+        deadbands: Optional[Dict[str, Optional[Deadband]]] = None,
     ):
         self.bus = bus
-        self.hostname = hostname
-        self.port = port
-        self.username = username
-        self.password = password
         self.home_assistant_mode = home_assistant_mode
         self.devices = []
 
+        # State is encoded once, and then published to every broker
+        primary = MqttBroker(hostname, port, username, password, spool, accept_commands=True)
+        self.brokers = [primary] + (mirrors or [])
+
+        # When state_max_age is set, unchanged state is only republished once
+        # it is that old. Fields with force_update in Home Assistant are
+        # republished even if unchanged, since it records every update.
+        self.state_max_age = state_max_age
+
+        # Changes within a field's deadband aren't published (until the max
+        # age, if set). Without a max age, force_update fields ignore their
+        # deadband, since there would be no heartbeat. The defaults can be
+        # overridden by field name, with "pack_details" for battery pack details.
+        self.deadbands = deadbands or {}
+
+        # State can be published to a topic per field ("topics"), as a JSON
+        # document per device ("json"), or both. The documents hold the latest
+        # value of every field, so each publish is complete.
+        self.state_format = state_format
+        self.state_documents: Dict[BluettiDevice, dict] = {}
+
+        # Built once per device, keyed by parsed field name and command topic
+        self.state_topics: Dict[BluettiDevice, str] = {}
+        self.state_fields: Dict[BluettiDevice, Dict[str, StateField]] = {}
+        self.command_routes: Dict[str, CommandRoute] = {}
+
+        # Publishes are pipelined, with up to max_in_flight awaiting a response
+        self.state_qos = state_qos
+        self.discovery_qos = discovery_qos
+        self.max_in_flight = max_in_flight
+
+        # Discovery configs are retained, so they only need publishing if
+        # they're missing or have changed since the last run
+        self.skip_unchanged_discovery = skip_unchanged_discovery
+
+        # Discovery can be sent as a config per entity ("entity"), or as a
+        # single config per device bundling all of its entities ("device")
+        self.discovery_format = discovery_format
+
+        # While a broker is unreachable, state can be recorded to its spool
+        # and replayed to history topics (at spool_replay_rate messages per
+        # second, or as fast as possible if 0) once connected again
+        self.spool_replay_rate = spool_replay_rate
+
+        # Raw responses can also be published, for decoding elsewhere
+        self.publish_registers = publish_registers
+        self.register_topics: Dict[BluettiDevice, str] = {}
+
+        # MQTT v5 allows topic aliases for state topics, so that the topic
+        # isn't sent every time, and state can expire after state_expiry
+        # seconds if it hasn't been delivered
+        self.mqtt_v5 = mqtt_v5
+        self.state_expiry = state_expiry
+
     async def run(self):
+        # Connect to event bus - if we fall behind, only the latest values for
+        # each device are worth publishing
+        subscriptions = [self.bus.add_parser_listener(
+            self.handle_messages,
+            overflow=OverflowPolicy.COALESCE,
+            batch=True
+        )]
+        if self.publish_registers:
+            subscriptions.append(self.bus.add_register_listener(
+                self.handle_registers,
+                overflow=OverflowPolicy.DROP_OLDEST
+            ))
+        try:
+            await asyncio.gather(*[self._run_broker(broker) for broker in self.brokers])
+        finally:
+            for subscription in subscriptions:
+                subscription.unsubscribe()
+
+    async def drain(self):
+        """Waits for pending state to be published to every connected broker"""
+        await asyncio.gather(*[broker.flushed.wait() for broker in self.brokers if broker.connected])
+
+    async def _run_broker(self, broker: MqttBroker):
         while True:
-            logging.info('Connecting to MQTT broker...')
+            logging.info(f'Connecting to MQTT broker {broker.name}...')
+            client = Client(
+                hostname=broker.hostname,
+                port=broker.port,
+                username=broker.username,
+                password=broker.password,
+                protocol=ProtocolVersion.V5 if self.mqtt_v5 else ProtocolVersion.V311
+            )
+            if self.mqtt_v5:
+                self._read_connect_properties(broker, client)
             try:
-                async with Client(
-                    hostname=self.hostname,
-                    port=self.port,
-                    username=self.username,
-                    password=self.password
-                ) as client:
-                    logging.info('Connected to MQTT broker')
-
-                    # Connect to event bus
-                    self.message_queue = asyncio.Queue()
-                    self.bus.add_parser_listener(self.handle_message)
+                async with client:
+                    logging.info(f'Connected to MQTT broker {broker.name}')
+
+                    # State isn't retained, so new subscribers need all of it again
+                    broker.published.clear()
+                    broker.clear()
+                    broker.connected = True
+                    if broker.spool:
+                        broker.spool.close()
 
                     # Handle pub/sub
-                    await asyncio.gather(
-                        self._handle_commands(client),
-                        self._handle_messages(client)
+                    publisher = MqttPublisher(
+                        client,
+                        self.max_in_flight,
+                        broker.topic_alias_maximum,
+                        self.state_expiry if self.mqtt_v5 else 0
                     )
+                    tasks = [
+                        asyncio.create_task(self._handle_demand(broker, client)),
+                        asyncio.create_task(self._handle_messages(broker, publisher)),
+                        asyncio.create_task(self._replay_spool(broker, publisher)),
+                    ]
+                    if broker.accept_commands:
+                        tasks.append(asyncio.create_task(self._handle_commands(client)))
+                    try:
+                        await asyncio.gather(*tasks)
+                    finally:
+                        # Don't leave the others running when one fails
+                        broker.connected = False
+                        for task in tasks:
+                            task.cancel()
+                        publisher.cancel()
             except MqttError:
-                logging.exception('MQTT error:')
+                logging.exception(f'MQTT error from {broker.name}:')
+                if broker.spool:
+                    logging.info(f'Spooling state to {broker.spool.directory} until reconnected')
                 await asyncio.sleep(5)
 
-    async def handle_message(self, msg: ParserMessage):
-        await self.message_queue.put(msg)
+    def _read_connect_properties(self, broker: MqttBroker, client: Client):
+        """Reads the broker's limits from the CONNACK, which asyncio-mqtt doesn't expose"""
+        on_connect = client._client.on_connect
+
+        def read(paho_client, userdata, flags, rc, properties: Optional[Properties] = None):
+            broker.topic_alias_maximum = getattr(properties, 'TopicAliasMaximum', 0)
+            on_connect(paho_client, userdata, flags, rc, properties)
+
+        client._client.on_connect = read
+
+    async def handle_messages(self, msgs: List[ParserMessage]):
+        # Skip encoding if there's nowhere for the state to go
+        if not any(broker.connected or broker.spool for broker in self.brokers):
+            return
+
+        for msg in msgs:
+            if msg.device not in self.devices:
+                self._register_device(msg.device)
+            updates = self._encode_message(msg)
+
+            for broker in self.brokers:
+                if broker.connected:
+                    broker.put(msg.device, updates)
+                elif broker.spool:
+                    for update in updates:
+                        await self._publish_state(broker, broker.spool, update)
+
+    async def handle_registers(self, msg: RegisterMessage):
+        if msg.device not in self.register_topics:
+            self.register_topics[msg.device] = f'bluetti/registers/{msg.device.type}-{msg.device.sn}'
+
+        # Timestamp and starting address, followed by the whole response
+        payload = REGISTER_HEADER.pack(msg.timestamp, msg.command.starting_address) + msg.response
+        topic = self.register_topics[msg.device]
+        updates = [StateUpdate(topic, payload, key=f'{topic}/{msg.command.starting_address}')]
+
+        # Binary payloads aren't spooled
+        for broker in self.brokers:
+            if broker.connected:
+                broker.put(None, updates)
 
     async def _handle_commands(self, client: Client):
         async with client.filtered_messages('bluetti/command/#') as messages:
-            await client.subscribe('bluetti/command/#')
+            # Devices registered later subscribe to their own topics
+            if len(self.command_routes) > 0:
+                await client.subscribe([(topic, 0) for topic in self.command_routes.keys()])
             async for mqtt_message in messages:
                 await self._handle_command(mqtt_message)
 
-    async def _handle_messages(self, client: Client):
+    async def _handle_demand(self, broker: MqttBroker, client: Client):
+        async with client.filtered_messages(HOME_ASSISTANT_STATUS_TOPIC) as status_messages:
+            async with client.filtered_messages('bluetti/wake/#') as wake_messages:
+                await client.subscribe([(HOME_ASSISTANT_STATUS_TOPIC, 0), ('bluetti/wake/#', 0)])
+                await asyncio.gather(
+                    self._handle_home_assistant_status(broker, status_messages),
+                    self._handle_wake(wake_messages)
+                )
+
+    async def _handle_home_assistant_status(self, broker: MqttBroker, messages):
+        async for mqtt_message in messages:
+            status = mqtt_message.payload.decode('ascii', errors='ignore')
+            if status == 'online':
+                # Home Assistant restarted, so republish all state
+                broker.published.clear()
+                broker.consumers_active = True
+                await self._put_demand()
+            elif status == 'offline':
+                broker.consumers_active = False
+                await self._put_demand()
+
+    async def _put_demand(self):
+        """Data is in demand while Home Assistant is online on any broker"""
+        states = [b.consumers_active for b in self.brokers if b.consumers_active is not None]
+        await self.bus.put(DemandMessage(None, any(states)))
+
+    async def _handle_wake(self, messages):
+        async for mqtt_message in messages:
+            m = WAKE_TOPIC_RE.match(mqtt_message.topic)
+            if not m:
+                logging.warn(f'unknown wake topic: {mqtt_message.topic}')
+                continue
+
+            device = next((d for d in self.devices if d.type == m[1] and d.sn == m[2]), None)
+            if not device:
+                logging.warn(f'unknown device: {m[1]} {m[2]}')
+                continue
+
+            await self.bus.put(DemandMessage(device, mqtt_message.payload != b'OFF'))
+
+    async def _handle_messages(self, broker: MqttBroker, publisher: MqttPublisher):
         while True:
-            msg: ParserMessage = await self.message_queue.get()
-            if msg.device not in self.devices:
-                await self._init_device(msg.device, client)
-            await self._handle_message(client, msg)
-            self.message_queue.task_done()
+            # Publish everything pending before waiting on the broker
+            await broker.has_pending.wait()
+            devices, updates = broker.take()
+            for device in devices:
+                if device not in broker.discovered:
+                    await self._init_device(device, broker, publisher)
+            for update in updates:
+                await self._publish_state(broker, publisher, update)
+            await publisher.flush()
+            if not broker.has_pending.is_set():
+                broker.flushed.set()
+
+            if broker.replaced > 0:
+                logging.debug('Replaced %d unpublished updates for %s with newer ones', broker.replaced, broker.name)
+                broker.replaced = 0
 
-    async def _init_device(self, device: BluettiDevice, client: Client):
-        # Register device
+    async def _replay_spool(self, broker: MqttBroker, publisher: MqttPublisher):
+        """Publishes spooled state to history topics, with the time it was recorded"""
+        if not broker.spool:
+            return
+
+        async for seq, records in broker.spool.replay():
+            logging.info(f'Replaying {len(records)} spooled messages to {broker.name}')
+            for record in records:
+                topic = 'bluetti/history/' + record['topic'][len('bluetti/state/'):]
+                payload = {'timestamp': record['timestamp'], 'payload': record['payload']}
+                await publisher.publish(topic, json.dumps(payload, separators=(',', ':')).encode(), qos=self.state_qos)
+                if self.spool_replay_rate > 0:
+                    await asyncio.sleep(1 / self.spool_replay_rate)
+
+            # Only remove the segment once the broker has all of it
+            await publisher.flush()
+            broker.spool.remove(seq)
+
+    def _register_device(self, device: BluettiDevice):
         self.devices.append(device)
+        self._build_state_fields(device)
+        self._build_command_routes(device)
+
+    async def _init_device(self, device: BluettiDevice, broker: MqttBroker, publisher: MqttPublisher):
+        broker.discovered.add(device)
+
+        # Subscribe to the device's command topics
+        routes = [topic for topic, route in self.command_routes.items() if route.device is device]
+        if broker.accept_commands and len(routes) > 0:
+            await publisher.client.subscribe([(topic, 0) for topic in routes])
 
         # Skip announcing device to Home Assistant if disabled
         if self.home_assistant_mode == 'none':
             return
 
-        def payload(id: str, device: BluettiDevice, field: MqttFieldConfig) -> str:
+        def payload(id: str, device: BluettiDevice, field: MqttFieldConfig) -> dict:
             ha_id = id if not field.id_override else field.id_override
             payload_dict = {
                 'state_topic': f'bluetti/state/{device.type}-{device.sn}/{id}',
-                'device': {
-                    'identifiers': [
-                        f'{device.sn}'
-                    ],
-                    'manufacturer': 'Bluetti',
-                    'name': f'{device.type} {device.sn}',
-                    'model': device.type
-                },
                 'unique_id': f'{device.sn}_{ha_id}',
                 'object_id': f'{device.type}_{ha_id}',
             }
+            if self.state_format == 'json' and 'value_template' not in field.home_assistant_extra:
+                payload_dict['state_topic'] = f'bluetti/state/{device.type}-{device.sn}'
+                payload_dict['value_template'] = f'{{{{ value_json.{id} }}}}'
             if field.setter:
                 payload_dict['command_topic'] = f'bluetti/command/{device.type}-{device.sn}/{id}'
             payload_dict.update(field.home_assistant_extra)
 
-            return json.dumps(payload_dict, separators=(',', ':'))
+            return payload_dict
 
-        # Publish normal fields
+        # Build components for normal fields, keyed by object id
+        components: Dict[str, Tuple[str, dict]] = {}
         for name, field in NORMAL_DEVICE_FIELDS.items():
             # Skip fields not supported by the device
             if not device.has_field(name):
@@ -597,14 +1032,9 @@ class MQTTClient:
             elif field.type == MqttFieldType.BUTTON:
                 type = 'button'
 
-            # Publish config
-            await client.publish(
-                f'homeassistant/{type}/{device.sn}_{name}/config',
-                payload=payload(name, device, field).encode(),
-                retain=True
-            )
+            components[f'{device.sn}_{name}'] = (type, payload(name, device, field))
 
-        # Publish battery pack configs
+        # Battery pack components
         for pack in range(1, device.pack_num_max + 1):
             fields = battery_pack_fields(pack)
             for name, field in fields.items():
@@ -612,109 +1042,259 @@ class MQTTClient:
                 if not device.has_field(name):
                     continue
 
-                # Publish config
-                await client.publish(
-                    f'homeassistant/sensor/{device.sn}_{field.id_override}/config',
-                    payload=payload(f'pack_details{pack}', device, field).encode(),
-                    retain=True
-                )
+                pack_payload = payload(f'pack_details{pack}', device, field)
+                components[f'{device.sn}_{field.id_override}'] = ('sensor', pack_payload)
 
-        # Publish DC input config
+        # DC input components
         if device.has_field('internal_dc_input_voltage'):
             for name, field in DC_INPUT_FIELDS.items():
-                await client.publish(
-                    f'homeassistant/sensor/{device.sn}_{name}/config',
-                    payload=payload(name, device, field).encode(),
-                    retain=True
-                )
+                components[f'{device.sn}_{name}'] = ('sensor', payload(name, device, field))
+
+        # Build configs, either one per entity or one for the whole device
+        device_info = {
+            'identifiers': [
+                f'{device.sn}'
+            ],
+            'manufacturer': 'Bluetti',
+            'name': f'{device.type} {device.sn}',
+            'model': device.type
+        }
+        device_topic = f'homeassistant/device/{device.sn}/config'
+        entity_topics = [f'homeassistant/{type}/{id}/config' for id, (type, _) in components.items()]
+        configs: Dict[str, bytes] = {}
+        if self.discovery_format == 'device':
+            config = {
+                'device': device_info,
+                'origin': DISCOVERY_ORIGIN,
+                'components': {id: {'platform': type, **c} for id, (type, c) in components.items()},
+            }
+            configs[device_topic] = json.dumps(config, separators=(',', ':')).encode()
+            stale_topics = entity_topics
+        else:
+            for topic, (_, c) in zip(entity_topics, components.values()):
+                config = {'state_topic': c['state_topic'], 'device': device_info, **c}
+                configs[topic] = json.dumps(config, separators=(',', ':')).encode()
+            stale_topics = [device_topic]
+
+        # Configs left over from the other discovery format are removed
+        # first, since Home Assistant rejects entities with duplicate unique
+        # ids. The per-entity configs are read back rather than all cleared on
+        # every connect, while a single device config is simply cleared.
+        read_topics = stale_topics if self.discovery_format == 'device' else []
+        if self.skip_unchanged_discovery:
+            read_topics = list(configs.keys()) + stale_topics
+        retained = await self._read_retained(publisher.client, read_topics) if read_topics else None
+        for topic in stale_topics:
+            if retained is None or retained.get(topic):
+                await publisher.publish(topic, b'', qos=self.discovery_qos, retain=True)
+
+        # Skip configs that the broker has already retained
+        total = len(configs)
+        if self.skip_unchanged_discovery:
+            configs = {topic: config for topic, config in configs.items() if retained.get(topic) != config}
+
+        for topic, config in configs.items():
+            await publisher.publish(topic, config, qos=self.discovery_qos, retain=True)
+
+        logging.info(
+            f'Sent {len(configs)} of {total} discovery messages of {device.type}-{device.sn} to Home Assistant '
+            f'on {broker.name}')
+
+    async def _read_retained(self, client: Client, topics: List[str]) -> Dict[str, bytes]:
+        """Reads back whatever the broker has retained for the given topics"""
+        retained = {}
+
+        async def read(messages):
+            async for mqtt_message in messages:
+                if mqtt_message.retain and mqtt_message.topic in topics:
+                    retained[mqtt_message.topic] = mqtt_message.payload
+                    if len(retained) == len(topics):
+                        return
 
-        logging.info(f'Sent discovery message of {device.type}-{device.sn} to Home Assistant')
+        # Topics without a retained message never get one, so stop waiting
+        # after a little while
+        async with client.filtered_messages('homeassistant/+/+/config') as messages:
+            await client.subscribe([(topic, 0) for topic in topics])
+            try:
+                await asyncio.wait_for(read(messages), self.DISCOVERY_READ_TIMEOUT)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                await client.unsubscribe(topics)
+        return retained
 
     async def _handle_command(self, mqtt_message: MQTTMessage):
-        # Parse the mqtt_message.topic
-        m = COMMAND_TOPIC_RE.match(mqtt_message.topic)
-        if not m:
+        route = self.command_routes.get(mqtt_message.topic)
+        if not route:
             logging.warn(f'unknown command topic: {mqtt_message.topic}')
             return
 
-        # Find the matching device for the command
-        device = next((d for d in self.devices if d.type == m[1] and d.sn == m[2]), None)
-        if not device:
-            logging.warn(f'unknown device: {m[1]} {m[2]}')
+        # Commands for several fields at once are sent to the device topic
+        if route.field is None:
+            await self._handle_json_command(route.device, mqtt_message)
             return
 
-        # Check if the device supports setting this field
-        if not device.has_field_setter(m[3]):
-            logging.warn(f'Received command for unknown topic: {m[3]} - {mqtt_message.topic}')
+        try:
+            value = route.decode(mqtt_message.payload)
+            self._check_limits(route.field, value)
+            cmd = route.device.build_setter_command(route.field, value)
+        except (KeyError, ValueError) as err:
+            logging.warn(f'Received invalid command for {mqtt_message.topic}: {err}')
             return
 
-        cmd: DeviceCommand = None
-        if m[3] in NORMAL_DEVICE_FIELDS:
-            field = NORMAL_DEVICE_FIELDS[m[3]]
-            if field.type == MqttFieldType.ENUM:
-                value = mqtt_message.payload.decode('ascii')
-                cmd = device.build_setter_command(m[3], value)
-            elif field.type == MqttFieldType.BOOL or field.type == MqttFieldType.BUTTON:
-                value = mqtt_message.payload == b'ON'
-                cmd = device.build_setter_command(m[3], value)
-            elif field.type == MqttFieldType.NUMERIC:
-                value = int(mqtt_message.payload.decode('ascii'))
-                cmd = device.build_setter_command(m[3], value)
-            else:
-                raise AssertionError(f'unexpected enum type: {field.type}')
-        else:
-            logging.warn(f'Received command for unhandled topic: {m[3]} - {mqtt_message.topic}')
+        await self.bus.put(CommandMessage(route.device, cmd))
+
+    async def _handle_json_command(self, device: BluettiDevice, mqtt_message: MQTTMessage):
+        try:
+            values = json.loads(mqtt_message.payload)
+        except ValueError:
+            logging.warn(f'Received invalid JSON command: {mqtt_message.topic}')
+            return
+        if not isinstance(values, dict) or len(values) == 0:
+            logging.warn(f'Received JSON command without any fields: {mqtt_message.topic}')
+            return
+
+        # Validate every field before sending anything, so the fields are
+        # either all set together or not at all
+        try:
+            for name, value in values.items():
+                if name not in NORMAL_DEVICE_FIELDS or not device.has_field_setter(name):
+                    raise ValueError(f'unknown field {name}')
+                values[name] = self._parse_json_value(NORMAL_DEVICE_FIELDS[name], value)
+                self._check_limits(name, values[name])
+            commands = device.build_multiple_setter_commands(values)
+        except (KeyError, ValueError) as err:
+            logging.warn(f'Received invalid JSON command for {mqtt_message.topic}: {err}')
             return
 
-        await self.bus.put(CommandMessage(device, cmd))
+        for cmd in commands:
+            await self.bus.put(CommandMessage(device, cmd))
+
+    def _check_limits(self, name: str, value: Any):
+        """Checks a numeric value against the limits given to Home Assistant"""
+        field = NORMAL_DEVICE_FIELDS[name]
+        if field.type != MqttFieldType.NUMERIC:
+            return
+        limits = field.home_assistant_extra
+        if ('min' in limits and value < limits['min']) or ('max' in limits and value > limits['max']):
+            raise ValueError(f'{name} is out of range: {value}')
+
+    def _parse_json_value(self, field: MqttFieldConfig, value: Any):
+        if field.type == MqttFieldType.ENUM:
+            if not isinstance(value, str):
+                raise ValueError(f'expected string value: {value}')
+            return value
+        elif field.type == MqttFieldType.BOOL or field.type == MqttFieldType.BUTTON:
+            if isinstance(value, bool):
+                return value
+            if value in ('ON', 'OFF'):
+                return value == 'ON'
+            raise ValueError(f'expected boolean value: {value}')
+        elif field.type == MqttFieldType.NUMERIC:
+            if isinstance(value, bool) or not isinstance(value, int):
+                raise ValueError(f'expected integer value: {value}')
+            return value
+        else:
+            raise AssertionError(f'unexpected enum type: {field.type}')
+
+    def _build_command_routes(self, device: BluettiDevice):
+        """Routes the device's command topics, which are the only ones subscribed to"""
+        topic = f'bluetti/command/{device.type}-{device.sn}'
+        routes = {}
+        for name, field in NORMAL_DEVICE_FIELDS.items():
+            if device.has_field_setter(name):
+                routes[f'{topic}/{name}'] = CommandRoute(device, name, FIELD_DECODERS[field.type])
+
+        # The JSON command topic is only useful if there's something to set
+        if len(routes) > 0:
+            self.command_routes[topic] = CommandRoute(device)
+            self.command_routes.update(routes)
+
+    def _build_state_fields(self, device: BluettiDevice):
+        """Compiles the topic and encoder for each field, so publishing state is just a lookup"""
+        topic = f'bluetti/state/{device.type}-{device.sn}'
+        fields = {}
+        for name, field in NORMAL_DEVICE_FIELDS.items():
+            fields[name] = StateField(
+                name,
+                f'{topic}/{name}',
+                FIELD_ENCODERS[field.type],
+                field.type == MqttFieldType.NUMERIC,
+                self.deadbands.get(name, field.deadband),
+                field.home_assistant_extra.get('force_update', False)
+            )
+        for name, internal_name in DC_INPUT_SOURCE_FIELDS.items():
+            fields[internal_name] = StateField(
+                name,
+                f'{topic}/{name}',
+                _encode_numeric,
+                True,
+                self.deadbands.get(name, DC_INPUT_FIELDS[name].deadband),
+                DC_INPUT_FIELDS[name].home_assistant_extra.get('force_update', False)
+            )
+
+        self.state_topics[device] = topic
+        self.state_fields[device] = fields
 
-    async def _handle_message(self, client: Client, msg: ParserMessage):
-        logging.debug(f'Got a message from {msg.device}: {msg.parsed}')
-        topic_prefix = f'bluetti/state/{msg.device.type}-{msg.device.sn}/'
+    def _encode_message(self, msg: ParserMessage) -> List[StateUpdate]:
+        logging.debug('Got a message from %s: %s', msg.device, msg.parsed)
+        topic = self.state_topics[msg.device]
+        fields = self.state_fields[msg.device]
+        publish_topics = self.state_format != 'json'
+        document = None
+        if self.state_format != 'topics':
+            document = self.state_documents.setdefault(msg.device, {})
+        document_updated = False
+        updates = []
 
-        # Publish normal fields
+        # Encode configured fields
         for name, value in msg.parsed.items():
-            # Skip unconfigured fields
-            if name not in NORMAL_DEVICE_FIELDS:
+            field = fields.get(name)
+            if field is None:
                 continue
 
-            # Build payload string
-            field = NORMAL_DEVICE_FIELDS[name]
-            if field.type == MqttFieldType.NUMERIC:
-                payload = str(value)
-            elif field.type == MqttFieldType.BOOL or field.type == MqttFieldType.BUTTON:
-                payload = 'ON' if value else 'OFF'
-            elif field.type == MqttFieldType.ENUM:
-                payload = value.name
-            else:
-                assert False, f'Unhandled field type: {field.type.name}'
-
-            await client.publish(topic_prefix + name, payload=payload.encode())
+            payload = field.encode(value)
+            if publish_topics:
+                updates.append(StateUpdate(field.topic, payload, value, field.deadband, field.force_update))
+            if document is not None:
+                document[field.name] = value if field.numeric else payload.decode()
+                document_updated = True
 
-        # Publish battery pack data
+        # Encode battery pack data
         pack_details = self._build_pack_details(msg.parsed)
         if 'pack_num' in msg.parsed and len(pack_details) > 0:
-            await client.publish(
-                topic_prefix + f'pack_details{msg.parsed["pack_num"]}',
-                payload=json.dumps(pack_details, separators=(',', ':')).encode()
-            )
+            updates.append(StateUpdate(
+                f'{topic}/pack_details{msg.parsed["pack_num"]}',
+                json.dumps(pack_details, separators=(',', ':')).encode(),
+                pack_details,
+                self.deadbands.get('pack_details', PACK_DETAILS_DEADBAND)
+            ))
 
-        # Publish DC input data
-        if 'internal_dc_input_voltage' in msg.parsed:
-            await client.publish(
-                topic_prefix + 'dc_input_voltage1',
-                payload=str(msg.parsed['internal_dc_input_voltage']).encode()
-            )
-        if 'internal_dc_input_power' in msg.parsed:
-            await client.publish(
-                topic_prefix + 'dc_input_power1',
-                payload=str(msg.parsed['internal_dc_input_power']).encode()
-            )
-        if 'internal_dc_input_current' in msg.parsed:
-            await client.publish(
-                topic_prefix + 'dc_input_current1',
-                payload=str(msg.parsed['internal_dc_input_current']).encode()
-            )
+        # Encode the whole device state
+        if document_updated:
+            updates.append(StateUpdate(topic, json.dumps(document, separators=(',', ':'), default=float).encode()))
+
+        return updates
+
+    async def _publish_state(
+        self,
+        broker: MqttBroker,
+        publisher: Union[MqttPublisher, DiskSpool],
+        update: StateUpdate,
+    ):
+        now = time.monotonic()
+        last = broker.published.get(update.topic)
+        if last and (self.state_max_age <= 0 or now - last[1] < self.state_max_age):
+            if self.state_max_age > 0 and last[0] == update.payload and not update.force_update:
+                return
+            # Without a max age there's no heartbeat, so force_update fields
+            # are published every poll for Home Assistant to record
+            deadband = update.deadband if self.state_max_age > 0 or not update.force_update else None
+            if deadband and update.value is not None and deadband.contains(last[2], update.value):
+                return
+        broker.published[update.topic] = (update.payload, now, update.value)
+
+        await publisher.publish(update.topic, update.payload, qos=self.state_qos, state=True)
 
     def _build_pack_details(self, parsed: dict):
         details = {}
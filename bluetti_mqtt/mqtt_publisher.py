@@ -0,0 +1,124 @@
+import asyncio
+import logging
+import time
+from typing import Dict, Optional, Set, Tuple
+from asyncio_mqtt import Client, MqttError
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+
+
+class PendingCallsFilter(logging.Filter):
+    """
+    asyncio-mqtt warns about more than 10 unacknowledged publishes, which is
+    expected with a larger window
+    """
+    def filter(self, record: logging.LogRecord) -> bool:
+        return 'pending publish calls' not in record.getMessage()
+
+
+PENDING_CALLS_FILTER = PendingCallsFilter()
+
+
+class MqttPublisher:
+    """
+    Pipelines publishes, so that sending a burst of messages isn't limited by
+    waiting on each one in turn. Up to max_in_flight publishes are awaited at
+    once, and errors are raised from the next publish or flush.
+
+    On MQTT v5 connections, state messages can also use topic aliases (up to
+    the broker's maximum) and a message expiry interval.
+    """
+    tasks: Set[asyncio.Task]
+    aliases: Dict[str, Properties]
+
+    def __init__(
+        self,
+        client: Client,
+        max_in_flight: int,
+        topic_alias_maximum: int = 0,
+        state_expiry: int = 0,
+    ):
+        self.client = client
+        self.in_flight = asyncio.Semaphore(max(max_in_flight, 1))
+        self.tasks = set()
+        self.error: Optional[MqttError] = None
+
+        if max_in_flight > 10:
+            logging.getLogger('mqtt').addFilter(PENDING_CALLS_FILTER)
+
+        # Properties are built once and shared between publishes
+        self.topic_alias_maximum = topic_alias_maximum
+        self.aliases = {}
+        self.state_properties = None
+        if state_expiry > 0:
+            self.state_properties = self._build_properties(state_expiry)
+        self.state_expiry = state_expiry
+
+        # Flush metrics
+        self.count = 0
+        self.first_publish_at: Optional[float] = None
+
+    async def publish(self, topic: str, payload: bytes, qos: int = 0, retain: bool = False, state: bool = False):
+        self._raise_error()
+        await self.in_flight.acquire()
+        if self.first_publish_at is None:
+            self.first_publish_at = time.monotonic()
+        self.count += 1
+
+        properties = None
+        if state:
+            topic, properties = self._state_topic(topic)
+
+        # Tasks start in order, so an alias is always set before it's used
+        task = asyncio.create_task(self._publish(topic, payload, qos, retain, properties))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def flush(self):
+        """Waits for every publish to complete, and logs how long they took"""
+        if len(self.tasks) > 0:
+            await asyncio.wait(set(self.tasks))
+        self._raise_error()
+
+        if self.first_publish_at is not None:
+            logging.debug(
+                'Flushed %d MQTT messages in %.3fs', self.count, time.monotonic() - self.first_publish_at)
+            self.count = 0
+            self.first_publish_at = None
+
+    def cancel(self):
+        for task in self.tasks:
+            task.cancel()
+
+    def _state_topic(self, topic: str) -> Tuple[str, Optional[Properties]]:
+        # Once an alias is set, the topic itself can be left out
+        if topic in self.aliases:
+            return '', self.aliases[topic]
+
+        if len(self.aliases) < self.topic_alias_maximum:
+            properties = self._build_properties(self.state_expiry)
+            properties.TopicAlias = len(self.aliases) + 1
+            self.aliases[topic] = properties
+            return topic, properties
+
+        return topic, self.state_properties
+
+    def _build_properties(self, expiry: int) -> Properties:
+        properties = Properties(PacketTypes.PUBLISH)
+        if expiry > 0:
+            properties.MessageExpiryInterval = expiry
+        return properties
+
+    async def _publish(self, topic: str, payload: bytes, qos: int, retain: bool, properties: Optional[Properties]):
+        try:
+            await self.client.publish(topic, payload=payload, qos=qos, retain=retain, properties=properties)
+        except MqttError as err:
+            self.error = err
+        finally:
+            self.in_flight.release()
+
+    def _raise_error(self):
+        if self.error:
+            err = self.error
+            self.error = None
+            raise err
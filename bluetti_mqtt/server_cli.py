@@ -3,18 +3,26 @@ import asyncio
 import logging
 import os
 import signal
-from typing import List
+from typing import List, Optional, Tuple
+from urllib.parse import unquote, urlparse
 import warnings
 import sys
-from bluetti_mqtt.bluetooth import scan_devices
+from bluetti_mqtt.bluetooth import MultiDeviceManager, scan_devices
 from bluetti_mqtt.bus import EventBus
 from bluetti_mqtt.device_handler import DeviceHandler
-from bluetti_mqtt.mqtt_client import MQTTClient
+from bluetti_mqtt.event_loop import LoopLagMonitor, install_uvloop
+from bluetti_mqtt.mqtt_client import DC_INPUT_FIELDS, NORMAL_DEVICE_FIELDS, Deadband, MqttBroker, MQTTClient
+from bluetti_mqtt.spool import DiskSpool
+from bluetti_mqtt.worker import WorkerPool
 
 
 class CommandLineHandler:
     def __init__(self, argv=None):
         self.argv = argv or sys.argv[:]
+        self.bus = None
+        self.mqtt_client = None
+        self.handler = None
+        self.stopping = False
 
     def execute(self):
         parser = argparse.ArgumentParser(
@@ -42,16 +50,148 @@ class CommandLineHandler:
             '--password',
             type=str,
             help='The optional MQTT broker password')
+        parser.add_argument(
+            '--mqtt-v5',
+            action='store_true',
+            help='Connect using MQTT v5, which allows topic aliases for state topics')
+        parser.add_argument(
+            '--state-expiry',
+            metavar='SECONDS',
+            default=0,
+            type=int,
+            help='With MQTT v5, discard state that hasn\'t been delivered after this long - default is no expiry')
+        parser.add_argument(
+            '--mirror',
+            metavar='URL',
+            action='append',
+            default=[],
+            help='An additional MQTT broker to publish to, as mqtt://[USERNAME:PASSWORD@]HOST[:PORT] - '
+                 'may be given more than once')
+        parser.add_argument(
+            '--mirror-commands',
+            action='store_true',
+            help='Also accept commands from mirrors - only use this if they aren\'t bridged to each other')
+        parser.add_argument(
+            '--state-max-age',
+            metavar='SECONDS',
+            default=0,
+            type=int,
+            help='Only publish unchanged values once they are this old - default is to publish every poll')
+        parser.add_argument(
+            '--deadband',
+            metavar='FIELD=LIMIT',
+            action='append',
+            default=[],
+            type=parse_deadband,
+            help='Skip publishing changes to a field within this limit, either absolute (0.5) or a percentage (2%%), '
+                 'or 0 to always publish - may be given more than once, with "pack_details" for battery packs')
+        parser.add_argument(
+            '--state-format',
+            default='topics',
+            choices=['topics', 'json', 'both'],
+            help='Publish state to a topic per field, as one JSON document per device, or both - '
+                 'defaults to a topic per field ("topics")')
+        parser.add_argument(
+            '--state-qos',
+            default=0,
+            type=int,
+            choices=[0, 1, 2],
+            help='The MQTT QoS level for state messages - defaults to %(default)s')
+        parser.add_argument(
+            '--discovery-qos',
+            default=0,
+            type=int,
+            choices=[0, 1, 2],
+            help='The MQTT QoS level for Home Assistant discovery messages - defaults to %(default)s')
+        parser.add_argument(
+            '--max-in-flight',
+            default=20,
+            type=int,
+            help='The maximum number of MQTT messages to send before waiting for the broker - '
+                 'defaults to %(default)s')
+        parser.add_argument(
+            '--spool-dir',
+            metavar='PATH',
+            help='Record state to this directory while the MQTT broker is unreachable, and replay it to '
+                 'history topics once reconnected - default is to drop state while disconnected')
+        parser.add_argument(
+            '--spool-max-size',
+            metavar='MB',
+            default=100,
+            type=int,
+            help='The maximum size of the spool - defaults to %(default)sMB')
+        parser.add_argument(
+            '--spool-drop',
+            default='oldest',
+            choices=['oldest', 'newest'],
+            help='What to drop when the spool is full - defaults to the oldest records ("oldest")')
+        parser.add_argument(
+            '--spool-replay-rate',
+            metavar='MESSAGES',
+            default=50,
+            type=int,
+            help='How many spooled messages to replay per second, or 0 for no limit - defaults to %(default)s')
+        parser.add_argument(
+            '--raw-registers',
+            default='off',
+            choices=['off', 'also', 'only'],
+            help='Publish the raw register responses from each device, alongside the parsed values ("also") or '
+                 'instead of them ("only") - defaults to "off"')
         parser.add_argument(
             '--interval',
             default=0,
             type=int,
             help='The polling interval - default is to poll as fast as possible')
+        parser.add_argument(
+            '--idle-interval',
+            default=0,
+            type=int,
+            help='The polling interval to use while Home Assistant is offline and no wake request is active - '
+                 'default is to always use the normal interval')
+        parser.add_argument(
+            '--max-concurrent-commands',
+            default=MultiDeviceManager.DEFAULT_MAX_CONCURRENT_COMMANDS,
+            type=int,
+            help='The maximum number of commands in flight across all devices on the bluetooth adapter, or 0 for '
+                 'no limit - defaults to %(default)s')
+        parser.add_argument(
+            '--workers',
+            default=0,
+            type=int,
+            help='The number of child processes to spread bluetooth polling across - '
+                 'default is to poll from the main process')
+        parser.add_argument(
+            '--shutdown-timeout',
+            metavar='SECONDS',
+            default=10,
+            type=int,
+            help='How long to wait on shutdown for pending commands and state to be sent - '
+                 'defaults to %(default)ss')
+        parser.add_argument(
+            '--uvloop',
+            action='store_true',
+            help='Use the uvloop event loop, if installed')
+        parser.add_argument(
+            '--loop-lag-report',
+            metavar='SECONDS',
+            default=0,
+            type=int,
+            help='How often to log event loop lag percentiles - default is to not measure lag')
         parser.add_argument(
             '--ha-config',
             default='normal',
             choices=['normal', 'none', 'advanced'],
             help='What fields to configure in Home Assistant - defaults to most fields ("normal")')
+        parser.add_argument(
+            '--ha-discovery-format',
+            default='entity',
+            choices=['entity', 'device'],
+            help='Send Home Assistant a discovery message per entity, or one bundling all of a device\'s entities - '
+                 'defaults to a message per entity ("entity")')
+        parser.add_argument(
+            '--skip-unchanged-discovery',
+            action='store_true',
+            help='Read back retained Home Assistant discovery configs, and only publish those that changed')
         parser.add_argument(
             'addresses',
             metavar='ADDRESS',
@@ -72,13 +212,15 @@ class CommandLineHandler:
             parser.print_help()
 
     def start(self, args: argparse.Namespace):
+        if args.uvloop:
+            install_uvloop()
         loop = asyncio.get_event_loop()
 
         # Register signal handlers for safe shutdown
         if sys.platform != 'win32':
             signals = (signal.SIGHUP, signal.SIGTERM, signal.SIGINT)
             for s in signals:
-                loop.add_signal_handler(s, lambda: asyncio.create_task(shutdown(loop)))
+                loop.add_signal_handler(s, lambda: asyncio.create_task(self.stop(loop, args.shutdown_timeout)))
 
         # Register a global exception handler so we don't hang
         loop.set_exception_handler(handle_global_exception)
@@ -93,6 +235,7 @@ class CommandLineHandler:
     async def run(self, args: argparse.Namespace):
         loop = asyncio.get_running_loop()
         bus = EventBus()
+        self.bus = bus
 
         # Set up strong reference for tasks
         self.background_tasks = set()
@@ -103,6 +246,19 @@ class CommandLineHandler:
         bus_task.add_done_callback(self.background_tasks.discard)
 
         # Start MQTT client
+        spool = self.build_spool(args)
+        mirrors = []
+        for url in args.mirror:
+            parsed = urlparse(url if '://' in url else f'mqtt://{url}')
+            port = parsed.port or 1883
+            mirrors.append(MqttBroker(
+                parsed.hostname,
+                port,
+                unquote(parsed.username) if parsed.username else None,
+                unquote(parsed.password) if parsed.password else None,
+                self.build_spool(args, f'{parsed.hostname}-{port}'),
+                accept_commands=args.mirror_commands,
+            ))
         mqtt_client = MQTTClient(
             bus=bus,
             hostname=args.hostname,
@@ -110,18 +266,105 @@ class CommandLineHandler:
             port=args.port,
             username=args.username,
             password=args.password,
+            state_max_age=args.state_max_age,
+            state_format=args.state_format,
+            state_qos=args.state_qos,
+            discovery_qos=args.discovery_qos,
+            max_in_flight=args.max_in_flight,
+            skip_unchanged_discovery=args.skip_unchanged_discovery,
+            discovery_format=args.ha_discovery_format,
+            spool=spool,
+            spool_replay_rate=args.spool_replay_rate,
+            mirrors=mirrors,
+            publish_registers=args.raw_registers != 'off',
+            mqtt_v5=args.mqtt_v5,
+            state_expiry=args.state_expiry,
+            deadbands=dict(args.deadband),
         )
+        self.mqtt_client = mqtt_client
         mqtt_task = loop.create_task(mqtt_client.run())
         self.background_tasks.add(mqtt_task)
         mqtt_task.add_done_callback(self.background_tasks.discard)
 
         # Start bluetooth handler (manages connections)
         addresses: List[str] = list(set(args.addresses))
-        handler = DeviceHandler(addresses, args.interval, bus)
+        if args.workers > 0:
+            handler = WorkerPool(
+                addresses,
+                args.workers,
+                args.interval,
+                bus,
+                idle_interval=args.idle_interval,
+                max_concurrent_commands=args.max_concurrent_commands,
+                use_uvloop=args.uvloop,
+                loop_lag_report=args.loop_lag_report,
+                parse_responses=args.raw_registers != 'only',
+                publish_registers=args.raw_registers != 'off',
+            )
+        else:
+            handler = DeviceHandler(
+                addresses,
+                args.interval,
+                bus,
+                idle_interval=args.idle_interval,
+                max_concurrent_commands=args.max_concurrent_commands,
+                parse_responses=args.raw_registers != 'only',
+                publish_registers=args.raw_registers != 'off',
+            )
+        self.handler = handler
         bluetooth_task = loop.create_task(handler.run())
         self.background_tasks.add(bluetooth_task)
         bluetooth_task.add_done_callback(self.background_tasks.discard)
 
+        # Start event loop lag monitor
+        if args.loop_lag_report > 0:
+            monitor_task = loop.create_task(LoopLagMonitor(args.loop_lag_report).run())
+            self.background_tasks.add(monitor_task)
+            monitor_task.add_done_callback(self.background_tasks.discard)
+
+    async def stop(self, loop: asyncio.AbstractEventLoop, timeout: int):
+        """Stops polling, and gives pending commands and state a chance to be sent before shutting down"""
+        # A second signal skips waiting
+        if self.stopping or not self.handler:
+            await shutdown(loop)
+            return
+        self.stopping = True
+
+        logging.info('Stopping polling...')
+        self.handler.stop_polling()
+        try:
+            await asyncio.wait_for(self.drain(), timeout)
+        except asyncio.TimeoutError:
+            logging.warn(f'Gave up waiting for pending commands and state after {timeout}s')
+        await shutdown(loop)
+
+    async def drain(self):
+        # Commands flow from the bus to the devices, and their results back
+        # through the bus to MQTT
+        await self.bus.drain()
+        await self.handler.drain()
+        await self.bus.drain()
+        await self.mqtt_client.drain()
+
+    def build_spool(self, args: argparse.Namespace, subdirectory: Optional[str] = None):
+        if not args.spool_dir:
+            return None
+        directory = os.path.join(args.spool_dir, subdirectory) if subdirectory else args.spool_dir
+        return DiskSpool(directory, args.spool_max_size * 1024 * 1024, args.spool_drop == 'oldest')
+
+
+def parse_deadband(value: str) -> Tuple[str, Optional[Deadband]]:
+    name, _, limit = value.partition('=')
+    if name not in NORMAL_DEVICE_FIELDS and name not in DC_INPUT_FIELDS and name != 'pack_details':
+        raise argparse.ArgumentTypeError(f'unknown field: {name}')
+    try:
+        deadband = Deadband.parse(limit)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid limit for {name}: {limit}')
+
+    # A limit of 0 removes the field's deadband
+    return name, deadband if deadband.absolute > 0 or deadband.percent > 0 else None
+
 
 def handle_global_exception(loop, context):
     if 'exception' in context:
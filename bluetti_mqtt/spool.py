@@ -0,0 +1,140 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import os
+import time
+from typing import AsyncIterator, BinaryIO, List, Optional, Tuple
+
+
+class DiskSpool:
+    """
+    Records state messages to disk while the MQTT broker is unreachable, so
+    that they can be replayed once it's back. Records are appended to segment
+    files as JSON lines. Once the spool reaches its maximum size, either the
+    oldest segments are deleted or new records are dropped.
+
+    File access happens on a single thread, in order, so the event loop
+    isn't blocked on disk. Segments are only removed once fully replayed, so
+    a segment interrupted by a disconnect is replayed again from the start.
+    """
+    SEGMENT_SIZE = 1024 * 1024
+    SEGMENT_PREFIX = 'spool-'
+    SEGMENT_SUFFIX = '.jsonl'
+
+    segments: List[List[int]]  # [sequence number, size] pairs, oldest first
+    file: Optional[BinaryIO]
+
+    def __init__(self, directory: str, max_size: int, drop_oldest: bool = True):
+        self.directory = directory
+        self.max_size = max_size
+        self.segment_size = max(min(self.SEGMENT_SIZE, max_size // 10), 1)
+        self.drop_oldest = drop_oldest
+        self.io = ThreadPoolExecutor(max_workers=1)
+        self.file = None  # Only used from the io thread
+        self.open_seq: Optional[int] = None
+        self.full = False
+
+        # Pick up anything left over from the last run
+        os.makedirs(directory, exist_ok=True)
+        self.segments = []
+        for name in os.listdir(directory):
+            if name.startswith(self.SEGMENT_PREFIX) and name.endswith(self.SEGMENT_SUFFIX):
+                seq = int(name[len(self.SEGMENT_PREFIX):-len(self.SEGMENT_SUFFIX)])
+                self.segments.append([seq, os.path.getsize(self._path(seq))])
+        self.segments.sort()
+
+    @property
+    def size(self):
+        return sum(size for _, size in self.segments)
+
+    async def publish(self, topic: str, payload: bytes, qos: int = 0, retain: bool = False, state: bool = False):
+        """Same interface as MqttPublisher, so state can be spooled instead of published"""
+        record = {'timestamp': time.time(), 'topic': topic, 'payload': payload.decode()}
+        self.append((json.dumps(record, separators=(',', ':')) + '\n').encode())
+
+    def append(self, data: bytes):
+        # Make room for the record
+        while self.size + len(data) > self.max_size:
+            if not self.full:
+                dropping = 'the oldest' if self.drop_oldest else 'new'
+                logging.warn(f'Spool in {self.directory} is full - dropping {dropping} records')
+                self.full = True
+            if not self.drop_oldest or len(self.segments) <= 1:
+                return
+            self.remove(self.segments[0][0])
+
+        if self.open_seq is None or self.segments[-1][1] + len(data) > self.segment_size:
+            self._open_segment()
+        self.io.submit(self._write, data)
+        self.segments[-1][1] += len(data)
+
+    def close(self):
+        """Closes the current segment, so that it can be replayed"""
+        if self.open_seq is not None:
+            self.io.submit(self._close_file)
+            self.open_seq = None
+        self.full = False
+
+    async def replay(self) -> AsyncIterator[Tuple[int, List[dict]]]:
+        """Yields the records of each closed segment, oldest first"""
+        loop = asyncio.get_running_loop()
+        for seq, _ in list(self.segments):
+            if seq == self.open_seq:
+                break
+
+            # Reads are queued behind any writes still in progress
+            records = await loop.run_in_executor(self.io, self._read, seq)
+            if records is not None:
+                yield seq, records
+
+    def remove(self, seq: int):
+        self.segments = [s for s in self.segments if s[0] != seq]
+        self.io.submit(self._remove_file, seq)
+
+    def _open_segment(self):
+        seq = self.segments[-1][0] + 1 if len(self.segments) > 0 else 0
+        self.segments.append([seq, 0])
+        self.open_seq = seq
+        self.io.submit(self._open_file, seq)
+
+    # The following are run on the io thread
+
+    def _open_file(self, seq: int):
+        self._close_file()
+        self.file = open(self._path(seq), 'ab')
+
+    def _close_file(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def _write(self, data: bytes):
+        try:
+            self.file.write(data)
+            self.file.flush()
+        except (AttributeError, OSError) as err:
+            logging.warn(f'Could not write to spool in {self.directory}: {err}')
+
+    def _read(self, seq: int) -> Optional[List[dict]]:
+        records = []
+        try:
+            with open(self._path(seq), 'rb') as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        # Partially written record from a crash
+                        continue
+        except FileNotFoundError:
+            return None
+        return records
+
+    def _remove_file(self, seq: int):
+        try:
+            os.remove(self._path(seq))
+        except FileNotFoundError:
+            pass
+
+    def _path(self, seq: int):
+        return os.path.join(self.directory, f'{self.SEGMENT_PREFIX}{seq:08d}{self.SEGMENT_SUFFIX}')
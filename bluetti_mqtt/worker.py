@@ -0,0 +1,320 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import multiprocessing
+from multiprocessing.connection import Connection
+import signal
+import time
+from typing import Dict, List, Tuple
+from bluetti_mqtt.bluetooth import MultiDeviceManager, build_device
+from bluetti_mqtt.bus import CommandMessage, DemandMessage, EventBus, ParserMessage, RegisterMessage
+from bluetti_mqtt.core import BluettiDevice, ReadHoldingRegisters
+from bluetti_mqtt.device_handler import DeviceHandler
+from bluetti_mqtt.event_loop import LoopLagMonitor, install_uvloop
+
+
+class WorkerPool:
+    """
+    Polls devices from child processes, so that bluetooth handling doesn't
+    compete with parsing and MQTT publishing for the GIL. Each worker polls a
+    shard of the addresses and streams the raw responses back over a pipe,
+    where they are parsed and put on the event bus. A worker that exits is
+    restarted without affecting the others.
+    """
+    MIN_RESTART_DELAY = 1
+    MAX_RESTART_DELAY = 60
+    EXIT_TIMEOUT = 5
+
+    connections: Dict[str, Connection]
+    poll_indexes: Dict[str, Dict[bytes, int]]
+    pending_polls: Dict[str, Tuple[int, dict]]
+
+    def __init__(
+        self,
+        addresses: List[str],
+        num_workers: int,
+        interval: int,
+        bus: EventBus,
+        idle_interval: int = 0,
+        max_concurrent_commands: int = MultiDeviceManager.DEFAULT_MAX_CONCURRENT_COMMANDS,
+        use_uvloop: bool = False,
+        loop_lag_report: int = 0,
+        parse_responses: bool = True,
+        publish_registers: bool = False,
+    ):
+        # Sort so that each device always ends up in the same worker
+        addresses = sorted(addresses)
+        self.shards = [s for s in (addresses[i::num_workers] for i in range(num_workers)) if len(s) > 0]
+        self.interval = interval
+        self.idle_interval = idle_interval
+        self.max_concurrent_commands = max_concurrent_commands
+        self.use_uvloop = use_uvloop
+        self.loop_lag_report = loop_lag_report
+        self.parse_responses = parse_responses
+        self.publish_registers = publish_registers
+        self.bus = bus
+        self.devices: Dict[str, BluettiDevice] = {}
+        self.connections = {}
+
+        # Responses to a device's polling commands are combined into one
+        # message, like DeviceHandler does
+        self.poll_indexes = {}
+        self.pending_polls = {}
+
+        # Sends can block once a pipe is full, so they're done from a thread,
+        # which also keeps them in order
+        self.send_executor = ThreadPoolExecutor(max_workers=1)
+        self.stopping = False  # Workers aren't restarted once set
+        self.exited = asyncio.Event()
+
+    async def run(self):
+        # Connect to event bus
+        self.bus.add_command_listener(self.handle_command)
+        self.bus.add_demand_listener(self.handle_demand)
+
+        # Each worker has a thread to block on reading its pipe
+        executor = ThreadPoolExecutor(max_workers=len(self.shards))
+        try:
+            await asyncio.gather(*[self._supervise(executor, shard) for shard in self.shards])
+        finally:
+            executor.shutdown(wait=False)
+            self.send_executor.shutdown(wait=False)
+            self.exited.set()
+
+    def stop_polling(self):
+        """Stops polling in every worker, while still performing commands"""
+        self.stopping = True
+        for conn in self._open_connections():
+            self._send(conn, ('stop', None, None))
+
+    async def drain(self):
+        """Waits for the workers to perform their pending commands and exit"""
+        self.stopping = True
+        for conn in self._open_connections():
+            self._send(conn, ('drain', None, None))
+        await self.exited.wait()
+
+    async def handle_command(self, msg: CommandMessage):
+        self._send(self.connections[msg.device.address], ('command', msg.device.address, msg.command))
+
+    async def handle_demand(self, msg: DemandMessage):
+        if msg.device is None:
+            for conn in set(self.connections.values()):
+                self._send(conn, ('demand', None, msg.active))
+        else:
+            self._send(self.connections[msg.device.address], ('demand', msg.device.address, msg.active))
+
+    async def _supervise(self, executor: ThreadPoolExecutor, shard: List[str]):
+        """Runs a worker for the shard, restarting it if it crashes"""
+        context = multiprocessing.get_context('spawn')
+        restart_delay = self.MIN_RESTART_DELAY
+        while True:
+            parent_conn, child_conn = context.Pipe()
+            process = context.Process(
+                target=run_worker,
+                args=(
+                    shard,
+                    self.interval,
+                    self.idle_interval,
+                    self.max_concurrent_commands,
+                    self.use_uvloop,
+                    self.loop_lag_report,
+                    logging.getLogger().level,
+                    child_conn,
+                ),
+                daemon=True,
+            )
+            process.start()
+            started_at = time.monotonic()
+            logging.info(f'Started worker process {process.pid} for {shard}')
+
+            # Only the child should hold its end, so we see EOF when it exits
+            child_conn.close()
+            for address in shard:
+                self.connections[address] = parent_conn
+
+            try:
+                await self._read(executor, parent_conn)
+            finally:
+                # Closing the pipe tells the worker to exit
+                parent_conn.close()
+                await self._wait_for_exit(process)
+
+            if self.stopping:
+                logging.info(f'Worker process for {shard} exited')
+                return
+
+            # Back off if the worker keeps crashing soon after starting
+            if time.monotonic() - started_at > self.MAX_RESTART_DELAY:
+                restart_delay = self.MIN_RESTART_DELAY
+            logging.warn(f'Worker process for {shard} exited with code {process.exitcode} - '
+                         f'restarting in {restart_delay}s')
+            await asyncio.sleep(restart_delay)
+            restart_delay = min(restart_delay * 2, self.MAX_RESTART_DELAY)
+            if self.stopping:
+                # Shutdown started while waiting, so there's nothing to restart for
+                return
+
+    async def _wait_for_exit(self, process: multiprocessing.Process):
+        """Joins the process without blocking the event loop, killing it if it doesn't exit"""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, process.join, self.EXIT_TIMEOUT)
+        if process.is_alive():
+            logging.warn(f'Worker process {process.pid} did not exit - killing it')
+            process.kill()
+            await loop.run_in_executor(None, process.join)
+
+    async def _read(self, executor: ThreadPoolExecutor, conn: Connection):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                address, name, command, response, timestamp = await loop.run_in_executor(executor, conn.recv)
+            except (EOFError, OSError):
+                # The worker exited, or was killed mid-send
+                return
+
+            # A bad response shouldn't take down the pool
+            try:
+                device = self._get_device(address, name)
+                if self.publish_registers:
+                    await self.bus.put(RegisterMessage(device, command, response, timestamp))
+                if self.parse_responses:
+                    parsed = device.parse(command.starting_address, command.parse_response(response))
+                    await self._put_parsed(device, command, parsed)
+            except Exception:
+                logging.exception(f'Error handling response to {command} from {address}:')
+
+    async def _put_parsed(self, device: BluettiDevice, command: ReadHoldingRegisters, parsed: dict):
+        index = self.poll_indexes[device.address].get(bytes(command))
+        if index is None:
+            # Not part of a poll, like reading back a write
+            await self.bus.put(ParserMessage(device, parsed))
+            return
+
+        # If a new poll started before the last one completed, the last one is
+        # missing responses, but send what we have
+        pending = self.pending_polls.pop(device.address, None)
+        if pending and index <= pending[0]:
+            await self.bus.put(ParserMessage(device, pending[1]))
+        elif pending:
+            parsed = {**pending[1], **parsed}
+
+        if index == len(self.poll_indexes[device.address]) - 1:
+            await self.bus.put(ParserMessage(device, parsed))
+        else:
+            self.pending_polls[device.address] = (index, parsed)
+
+    def _open_connections(self):
+        # A crashed worker's pipe stays closed until it's restarted
+        return [conn for conn in set(self.connections.values()) if not conn.closed]
+
+    def _send(self, conn: Connection, msg: tuple):
+        self.send_executor.submit(self._send_blocking, conn, msg)
+
+    def _send_blocking(self, conn: Connection, msg: tuple):
+        try:
+            conn.send(msg)
+        except OSError as err:
+            logging.warn(f'Could not send {msg[0]} to worker process: {err}')
+
+    def _get_device(self, address: str, name: str):
+        if address not in self.devices:
+            device = build_device(address, name)
+            self.poll_indexes[address] = {bytes(c): i for i, c in enumerate(device.polling_commands)}
+            self.devices[address] = device
+        return self.devices[address]
+
+
+def run_worker(
+    addresses: List[str],
+    interval: int,
+    idle_interval: int,
+    max_concurrent_commands: int,
+    use_uvloop: bool,
+    loop_lag_report: int,
+    log_level: int,
+    conn: Connection,
+):
+    """Entry point for worker processes"""
+    logging.basicConfig(
+        datefmt='%Y-%m-%d %H:%M:%S',
+        format='%(asctime)s %(levelname)-8s %(message)s',
+        level=log_level
+    )
+
+    # The parent process is responsible for shutting us down, including when
+    # a service manager signals the whole process group
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    if use_uvloop:
+        install_uvloop()
+    asyncio.run(_run_worker(addresses, interval, idle_interval, max_concurrent_commands, loop_lag_report, conn))
+
+
+async def _run_worker(
+    addresses: List[str],
+    interval: int,
+    idle_interval: int,
+    max_concurrent_commands: int,
+    loop_lag_report: int,
+    conn: Connection,
+):
+    loop = asyncio.get_running_loop()
+    bus = EventBus()
+    handler = DeviceHandler(
+        addresses,
+        interval,
+        bus,
+        idle_interval=idle_interval,
+        max_concurrent_commands=max_concurrent_commands,
+        parse_responses=False,
+    )
+
+    # Stream responses to the parent process, from a thread in case the pipe is full
+    send_executor = ThreadPoolExecutor(max_workers=1)
+
+    async def send_response(msg: RegisterMessage):
+        name = handler.manager.get_name(msg.device.address)
+        response = (msg.device.address, name, msg.command, msg.response, msg.timestamp)
+        await loop.run_in_executor(send_executor, conn.send, response)
+    bus.add_register_listener(send_response)
+
+    # Receive commands from the parent process
+    async def read_commands():
+        executor = ThreadPoolExecutor(max_workers=1)
+        while True:
+            try:
+                kind, address, value = await loop.run_in_executor(executor, conn.recv)
+            except EOFError:
+                raise RuntimeError('Parent process exited')
+
+            if address is not None and not handler.manager.is_ready(address):
+                logging.debug(f'Dropping {kind} for {address} since it is not connected')
+                continue
+
+            if kind == 'command':
+                await bus.put(CommandMessage(handler.get_device(address), value))
+            elif kind == 'demand':
+                device = handler.get_device(address) if address else None
+                await bus.put(DemandMessage(device, value))
+            elif kind == 'stop':
+                handler.stop_polling()
+            elif kind == 'drain':
+                # Finish pending commands and send their responses, then exit
+                handler.stop_polling()
+                await bus.drain()
+                await handler.drain()
+                await bus.drain()
+                return
+
+    tasks = [bus.run(), handler.run(), read_commands()]
+    if loop_lag_report > 0:
+        tasks.append(LoopLagMonitor(loop_lag_report, f'worker {addresses}').run())
+    tasks = [asyncio.create_task(t) for t in tasks]
+
+    # Only read_commands finishes without an error, once drained. Exiting
+    # cancels the rest, which disconnects from the devices.
+    done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    for task in done:
+        task.result()
@@ -0,0 +1,25 @@
+from bluetti_mqtt.bus import EventBus
+
+
+class RecordingBus(EventBus):
+    """Records messages put on the bus instead of delivering them"""
+
+    def __init__(self):
+        super().__init__()
+        self.sent = []
+
+    async def put(self, msg):
+        self.sent.append(msg)
+
+
+class RecordingPublisher:
+    """Records published payloads, with the same interface as MqttPublisher"""
+
+    def __init__(self):
+        self.published = []
+        self.retained = {}
+
+    async def publish(self, topic: str, payload: bytes, qos: int = 0, retain: bool = False, state: bool = False):
+        self.published.append(payload)
+        if retain:
+            self.retained[topic] = payload
@@ -0,0 +1,42 @@
+import unittest
+from bluetti_mqtt.bluetooth import build_device
+from bluetti_mqtt.bus import EventBus, Listener, OverflowPolicy, ParserMessage
+
+
+class TestSubscriptions(unittest.TestCase):
+    def test_shared_listener_stays_until_every_subscription_is_removed(self):
+        async def callback(msg):
+            pass
+
+        bus = EventBus()
+        first = bus.add_parser_listener(callback)
+        second = bus.add_parser_listener(callback)
+        self.assertEqual(len(bus.listeners[ParserMessage]), 1)
+
+        first.unsubscribe()
+        first.unsubscribe()
+        self.assertEqual(len(bus.listeners[ParserMessage]), 1)
+
+        second.unsubscribe()
+        self.assertEqual(len(bus.listeners[ParserMessage]), 0)
+
+
+class TestCoalesce(unittest.IsolatedAsyncioTestCase):
+    async def test_only_merges_into_newest_message_for_device(self):
+        async def callback(msg):
+            pass
+
+        device = build_device('00:11:22:33:44:55', 'AC3001234567890123')
+        listener = Listener(callback, 2, OverflowPolicy.COALESCE)
+        await listener.put(ParserMessage(device, {'ac_output_power': 1}))
+        await listener.put(ParserMessage(device, {'pack_num': 1, 'pack_voltage': 52.1, 'ac_output_power': 5}))
+        await listener.put(ParserMessage(device, {'pack_num': 2, 'pack_voltage': 52.3, 'ac_output_power': 9}))
+
+        # The oldest is dropped rather than 9 being queued ahead of 5
+        powers = [msg.parsed['ac_output_power'] for _, msg in listener.pending]
+        self.assertEqual(powers, [5, 9])
+        self.assertEqual(listener.dropped, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import json
+import unittest
+from paho.mqtt.client import MQTTMessage
+from bluetti_mqtt.bluetooth import build_device
+from bluetti_mqtt.mqtt_client import MQTTClient
+from helpers import RecordingBus
+
+
+def build_message(topic: str, payload: bytes):
+    msg = MQTTMessage(topic=topic.encode())
+    msg.payload = payload
+    return msg
+
+
+class TestSetterValidation(unittest.TestCase):
+    def setUp(self):
+        self.device = build_device('00:11:22:33:44:55', 'AC3001234567890123')
+
+    def test_out_of_range_values(self):
+        for value in (70000, -5):
+            with self.assertRaisesRegex(ValueError, 'battery_range_start'):
+                self.device.build_setter_command('battery_range_start', value)
+            with self.assertRaisesRegex(ValueError, 'battery_range_start'):
+                self.device.build_multiple_setter_commands({'battery_range_start': value})
+
+    def test_unknown_enum_option(self):
+        with self.assertRaisesRegex(ValueError, 'ups_mode'):
+            self.device.build_setter_command('ups_mode', 'BOGUS')
+
+
+class TestCommandHandling(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.bus = RecordingBus()
+        self.client = MQTTClient(self.bus, 'localhost', 'none')
+        self.device = build_device('00:11:22:33:44:55', 'AC3001234567890123')
+        self.client._register_device(self.device)
+
+    async def test_out_of_range_field_command(self):
+        for payload in (b'70000', b'-1', b'101'):
+            with self.assertLogs(level='WARNING'):
+                await self.client._handle_command(
+                    build_message('bluetti/command/AC300-1234567890123/battery_range_start', payload))
+        self.assertEqual(self.bus.sent, [])
+
+    async def test_out_of_range_json_command(self):
+        for value in (70000, -5):
+            payload = json.dumps({'battery_range_start': value, 'battery_range_end': 90}).encode()
+            with self.assertLogs(level='WARNING'):
+                await self.client._handle_command(build_message('bluetti/command/AC300-1234567890123', payload))
+        self.assertEqual(self.bus.sent, [])
+
+    async def test_valid_json_command(self):
+        payload = json.dumps({'battery_range_start': 20, 'battery_range_end': 90}).encode()
+        await self.client._handle_command(build_message('bluetti/command/AC300-1234567890123', payload))
+        self.assertEqual(len(self.bus.sent), 1)
+
+    async def test_no_routes_without_setters(self):
+        device = build_device('00:11:22:33:44:77', 'AC601234567890123')
+        self.client._register_device(device)
+        self.assertFalse(any(route.device is device for route in self.client.command_routes.values()))
+        self.assertIn('bluetti/command/AC300-1234567890123', self.client.command_routes)
+
+
+if __name__ == '__main__':
+    unittest.main()
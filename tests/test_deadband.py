@@ -0,0 +1,47 @@
+import unittest
+from bluetti_mqtt.bus import EventBus
+from bluetti_mqtt.mqtt_client import Deadband, MQTTClient, StateUpdate
+from helpers import RecordingPublisher
+
+
+class TestDeadband(unittest.TestCase):
+    def test_absolute_and_percent(self):
+        self.assertTrue(Deadband(absolute=0.5).contains(230.0, 230.4))
+        self.assertFalse(Deadband(absolute=0.5).contains(230.0, 230.6))
+        self.assertTrue(Deadband.parse('2%').contains(230.0, 234.0))
+        self.assertFalse(Deadband.parse('2%').contains(230.0, 235.0))
+
+    def test_pack_details_compared_by_key(self):
+        deadband = Deadband(absolute=0.02)
+        last = {'percent': 50, 'voltage': 52.1}
+        self.assertTrue(deadband.contains(last, {'percent': 50, 'voltage': 52.11}))
+        self.assertFalse(deadband.contains(last, {'status': 'OK', 'percent': 50, 'voltage': 52.1}))
+        self.assertFalse(deadband.contains({'status': 'OK', 'voltage': 52.1}, {'voltage': 'OK', 'status': 52.1}))
+
+
+class TestPublishState(unittest.IsolatedAsyncioTestCase):
+    async def publish_voltages(self, state_max_age: int, force_update: bool):
+        client = MQTTClient(EventBus(), 'localhost', 'none', state_max_age=state_max_age)
+        publisher = RecordingPublisher()
+        for value in (230.1, 230.1, 230.3, 231.0):
+            update = StateUpdate(
+                'bluetti/state/AC300-1234/internal_ac_voltage',
+                str(value).encode(),
+                value,
+                Deadband(absolute=0.5),
+                force_update,
+            )
+            await client._publish_state(client.brokers[0], publisher, update)
+        return publisher.published
+
+    async def test_force_update_without_max_age(self):
+        published = await self.publish_voltages(0, True)
+        self.assertEqual(published, [b'230.1', b'230.1', b'230.3', b'231.0'])
+
+    async def test_deadband_with_max_age(self):
+        self.assertEqual(await self.publish_voltages(300, True), [b'230.1', b'231.0'])
+        self.assertEqual(await self.publish_voltages(0, False), [b'230.1', b'231.0'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+import unittest
+from bluetti_mqtt.mqtt_client import MqttBroker, MQTTClient
+from helpers import RecordingBus
+
+
+class FakeMessage:
+    def __init__(self, payload: bytes):
+        self.payload = payload
+
+
+async def messages(*payloads: bytes):
+    for payload in payloads:
+        yield FakeMessage(payload)
+
+
+class TestDemand(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.bus = RecordingBus()
+        self.client = MQTTClient(self.bus, 'localhost', 'none', mirrors=[MqttBroker('central')])
+        self.primary, self.mirror = self.client.brokers
+
+    def active(self):
+        return [msg.active for msg in self.bus.sent]
+
+    async def test_online_on_any_broker(self):
+        await self.client._handle_home_assistant_status(self.primary, messages(b'online'))
+        await self.client._handle_home_assistant_status(self.mirror, messages(b'offline'))
+        self.assertEqual(self.active(), [True, True])
+
+        await self.client._handle_home_assistant_status(self.primary, messages(b'offline'))
+        self.assertEqual(self.active(), [True, True, False])
+
+    async def test_mirror_commands_off_by_default(self):
+        self.assertTrue(self.primary.accept_commands)
+        self.assertFalse(self.mirror.accept_commands)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,27 @@
+import time
+import unittest
+from bluetti_mqtt.bus import EventBus
+from bluetti_mqtt.device_handler import DeviceHandler
+
+
+class TestPollAlignment(unittest.IsolatedAsyncioTestCase):
+    async def aligned_after(self, interval: int, slot: int) -> float:
+        handler = DeviceHandler(['00:11:22:33:44:55', '00:11:22:33:44:66'], interval, EventBus())
+        handler.STAGGER_DELAY = 0.1
+        handler.epoch = time.monotonic() - 4.5  # Connecting took a while
+
+        start = time.monotonic()
+        await handler._align('00:11:22:33:44:55', handler._phase_offset(slot))
+        return time.monotonic() - start
+
+    async def test_staggered_from_connection_without_interval(self):
+        self.assertLess(await self.aligned_after(0, 0), 0.05)
+        self.assertGreaterEqual(await self.aligned_after(0, 1), 0.1)
+
+    async def test_aligned_to_slots_with_interval(self):
+        # Slots are at epoch + 1 + 2k, so the next is at epoch + 5
+        self.assertAlmostEqual(await self.aligned_after(2, 1), 0.5, delta=0.1)
+
+
+if __name__ == '__main__':
+    unittest.main()
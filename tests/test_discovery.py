@@ -0,0 +1,33 @@
+import unittest
+from unittest.mock import AsyncMock
+from bluetti_mqtt.bluetooth import build_device
+from bluetti_mqtt.mqtt_client import MQTTClient
+from helpers import RecordingBus, RecordingPublisher
+
+
+class TestStaleDiscoveryConfigs(unittest.IsolatedAsyncioTestCase):
+    async def init_device(self, discovery_format: str, retained: dict):
+        client = MQTTClient(RecordingBus(), 'localhost', 'normal', discovery_format=discovery_format)
+        device = build_device('00:11:22:33:44:55', 'AC3001234567890123')
+        client._register_device(device)
+        client._read_retained = AsyncMock(return_value=retained)
+
+        publisher = RecordingPublisher()
+        publisher.client = AsyncMock()
+        await client._init_device(device, client.brokers[0], publisher)
+        return publisher.retained
+
+    async def test_switching_to_device_format_clears_entity_configs(self):
+        stale = 'homeassistant/sensor/1234567890123_dc_input_power/config'
+        retained = await self.init_device('device', {stale: b'{}'})
+        self.assertEqual(retained[stale], b'')
+        self.assertEqual(len([p for p in retained.values() if p == b'']), 1)
+        self.assertNotEqual(retained['homeassistant/device/1234567890123/config'], b'')
+
+    async def test_switching_to_entity_format_clears_device_config(self):
+        retained = await self.init_device('entity', {})
+        self.assertEqual(retained['homeassistant/device/1234567890123/config'], b'')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import os
+import tempfile
+import unittest
+from bluetti_mqtt.spool import DiskSpool
+
+
+class TestDiskSpool(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def build_spool(self, max_size: int, drop_oldest: bool = True) -> DiskSpool:
+        spool = DiskSpool(self.tmp.name, max_size, drop_oldest)
+        self.addCleanup(spool.io.shutdown)
+        return spool
+
+    async def fill(self, spool: DiskSpool, count: int):
+        for i in range(count):
+            await spool.publish('bluetti/state/AC300-1234/dc_input_power', str(i).encode())
+        spool.close()
+
+    async def replayed(self, spool: DiskSpool):
+        replayed = []
+        async for _, records in spool.replay():
+            replayed.extend(int(r['payload']) for r in records)
+        return replayed
+
+    async def test_rolls_over_segments_and_replays_in_order(self):
+        spool = self.build_spool(10000)
+        await self.fill(spool, 100)
+        self.assertGreater(len(spool.segments), 1)
+        self.assertEqual(await self.replayed(spool), list(range(100)))
+
+    async def test_open_segment_is_not_replayed(self):
+        spool = self.build_spool(10000)
+        await spool.publish('bluetti/state/AC300-1234/dc_input_power', b'1')
+        self.assertEqual(await self.replayed(spool), [])
+
+    async def test_drops_oldest_when_full(self):
+        spool = self.build_spool(1000)
+        await self.fill(spool, 100)
+        self.assertLessEqual(spool.size, 1000)
+        replayed = await self.replayed(spool)
+        self.assertEqual(replayed, list(range(replayed[0], 100)))
+        self.assertGreater(replayed[0], 0)
+
+    async def test_drops_newest_when_full(self):
+        spool = self.build_spool(1000, drop_oldest=False)
+        await self.fill(spool, 100)
+        self.assertLessEqual(spool.size, 1000)
+        replayed = await self.replayed(spool)
+        self.assertEqual(replayed, list(range(len(replayed))))
+        self.assertLess(len(replayed), 100)
+
+    async def test_resumes_segments_after_restart(self):
+        spool = self.build_spool(10000)
+        await self.fill(spool, 50)
+        spool.io.shutdown(wait=True)
+
+        resumed = self.build_spool(10000)
+        self.assertEqual(resumed.segments, spool.segments)
+        self.assertEqual(await self.replayed(resumed), list(range(50)))
+
+        # New records go after the old ones
+        await self.fill(resumed, 1)
+        self.assertEqual((await self.replayed(resumed))[-1], 0)
+        self.assertEqual(len(await self.replayed(resumed)), 51)
+
+    async def test_remove_deletes_replayed_segments(self):
+        spool = self.build_spool(10000)
+        await self.fill(spool, 100)
+        async for seq, _ in spool.replay():
+            spool.remove(seq)
+        spool.io.shutdown(wait=True)
+        self.assertEqual(spool.segments, [])
+        self.assertEqual(os.listdir(self.tmp.name), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,35 @@
+import unittest
+from bluetti_mqtt.core import ReadHoldingRegisters
+from bluetti_mqtt.worker import WorkerPool
+from helpers import RecordingBus
+
+
+class TestPollAggregation(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.bus = RecordingBus()
+        self.pool = WorkerPool(['00:11:22:33:44:55'], 1, 0, self.bus)
+        self.device = self.pool._get_device('00:11:22:33:44:55', 'AC3001234567890123')
+        self.commands = self.device.polling_commands
+
+    def parsed(self):
+        return [msg.parsed for msg in self.bus.sent]
+
+    async def test_combines_responses_to_a_poll(self):
+        for i, command in enumerate(self.commands):
+            await self.pool._put_parsed(self.device, command, {f'field{i}': i})
+        self.assertEqual(self.parsed(), [{'field0': 0, 'field1': 1, 'field2': 2}])
+
+    async def test_sends_incomplete_poll_when_the_next_starts(self):
+        await self.pool._put_parsed(self.device, self.commands[0], {'a': 1})
+        await self.pool._put_parsed(self.device, self.commands[1], {'b': 2})
+        await self.pool._put_parsed(self.device, self.commands[0], {'a': 3})
+        self.assertEqual(self.parsed(), [{'a': 1, 'b': 2}])
+
+    async def test_sends_other_responses_alone(self):
+        await self.pool._put_parsed(self.device, self.commands[0], {'a': 1})
+        await self.pool._put_parsed(self.device, ReadHoldingRegisters(3007, 1), {'ac_output_on': True})
+        self.assertEqual(self.parsed(), [{'ac_output_on': True}])
+
+
+if __name__ == '__main__':
+    unittest.main()